@@ -1,8 +1,10 @@
 import pygame
 import math
+import numpy as np
 import pandas as pd
 from routing import Location
 
+import utility
 from predictor import Predictor
 
 WHITE = (255, 255, 255)
@@ -399,7 +401,8 @@ def draw_connections(screen, data_connections, draw_traffic=False):
 
 def generate_weighted_connections(data_connections, split_lines=True):
     segments = []
-    max_traffic = 0
+    # The position and direction each segment's traffic is predicted for, all predicted at once at the end
+    segment_inputs = []
     for conn in data_connections:
         # Use screen positions to calculate number of segments because coords are not normalised
         pos_a_screen = CardinalDir.pos_to_screen(conn.node_a.pos)
@@ -417,69 +420,63 @@ def generate_weighted_connections(data_connections, split_lines=True):
         # print("Delta = ({0}, {1})".format(delta[0], delta[1]))
         if not split_lines:
             # traffic = 5  # TEST VALUE
-            traffic = get_traffic(pos_a[0], pos_a[1], direction, SELECTION.chosen_time, SELECTION.chosen_date)
             screen_start = CardinalDir.pos_to_screen(pos_a)
             screen_end = CardinalDir.pos_to_screen(pos_b)
-            segment = Segment(screen_start, screen_end, traffic)
+            segment = Segment(screen_start, screen_end)
             segments.append(segment)
-            max_traffic = max(max_traffic, traffic)
+            segment_inputs.append((pos_a[0], pos_a[1], direction))
 
             # Reverse line with offset:
             # traffic = 5  # TEST VALUE
-            traffic = get_traffic(pos_a[0], pos_a[1], direction, SELECTION.chosen_time, SELECTION.chosen_date)
             screen_start = CardinalDir.pos_to_screen(pos_b)
             screen_start = [screen_start[0] + 1, screen_start[1] + 1]
             screen_end = CardinalDir.pos_to_screen(pos_a)
             screen_end = [screen_end[0] + 1, screen_end[1] + 1]
-            segment = Segment(screen_start, screen_end, traffic)
+            segment = Segment(screen_start, screen_end)
             segments.append(segment)
-            max_traffic = max(max_traffic, traffic)
+            segment_inputs.append((pos_a[0], pos_a[1], direction))
         else:
             start_pos = pos_a
             for i in range(num_segments):
                 # traffic = i  # TEST VALUE
-                traffic = get_traffic(pos_a[0], pos_a[1], direction, SELECTION.chosen_time, SELECTION.chosen_date)
                 screen_start = CardinalDir.pos_to_screen(start_pos)
                 start_pos = [start_pos[0] + d[0], start_pos[1] + d[1]]
                 screen_end = CardinalDir.pos_to_screen(start_pos)
-                segment = Segment(screen_start, screen_end, float(traffic))
+                segment = Segment(screen_start, screen_end)
                 segments.append(segment)
-                max_traffic = max(max_traffic, traffic)
+                segment_inputs.append((pos_a[0], pos_a[1], direction))
 
             direction = CardinalDir.opposite_int(direction)
             start_pos = pos_b
             for i in range(num_segments):
                 # traffic = i  # TEST VALUE
-                traffic = get_traffic(pos_a[0], pos_a[1], direction, SELECTION.chosen_time, SELECTION.chosen_date)
                 screen_start = CardinalDir.pos_to_screen(start_pos)
                 screen_start = [screen_start[0] + 2, screen_start[1] + 2]
                 start_pos = [start_pos[0] - d[0], start_pos[1] - d[1]]
                 screen_end = CardinalDir.pos_to_screen(start_pos)
                 screen_end = [screen_end[0] + 2, screen_end[1] + 2]
-                segment = Segment(screen_start, screen_end, float(traffic))
+                segment = Segment(screen_start, screen_end)
                 segments.append(segment)
-                max_traffic = max(max_traffic, traffic)
-
-        max_traffic = 0.280
-        for segment in segments:
-            segment.create_colour_using_max_traffic(max_traffic)
-        SELECTION.data_segments = segments
-
-
-def get_traffic(latitude, longitude, direction, time, date):
-    inputs = [{
-        "latitude": latitude,
-        "longitude": longitude,
-        "direction": CardinalDir.int_to_short_str(direction),
-        "time": time,
-        "date": date
-    }]
-    prediction = PREDICTOR.make_prediction(inputs)
-    print(prediction[0])
-    return prediction[0]
-    # Use this to give the code (generate_weighted_connections) a traffic prediction for the specified point.
-    # Should return a number (int ok but float better).
-    # The algorithm will automatically find the maximum and generate colours which represent the range.
+                segment_inputs.append((pos_a[0], pos_a[1], direction))
+
+    if segment_inputs:
+        latitudes, longitudes, directions = np.array(segment_inputs).T
+        traffic = get_traffic(latitudes, longitudes, directions, SELECTION.chosen_time, SELECTION.chosen_date)
+        for segment, segment_traffic in zip(segments, traffic.tolist()):
+            segment.traffic = segment_traffic
+
+    max_traffic = 0.280
+    for segment in segments:
+        segment.create_colour_using_max_traffic(max_traffic)
+    SELECTION.data_segments = segments
+
+
+def get_traffic(latitudes, longitudes, directions, time, date):
+    # Gives the code (generate_weighted_connections) a traffic prediction for each of the specified points.
+    # Returns an array of floats, the algorithm will automatically find the maximum and generate colours which
+    # represent the range.
+    return PREDICTOR.make_predictions(latitudes, longitudes, directions, utility.convert_time_to_interval(time),
+                                      utility.convert_date_string_to_day(date))
 
 
 def render_text_multi_lines(screen, pos, string, max_length=20, text_size=12):
@@ -1,14 +1,25 @@
-from math import asin
+import glob
+import hashlib
+import json
+import os
+from functools import lru_cache
 from time import gmtime, strftime
 
 import numpy as np
 import pandas as pd
-from sklearn.preprocessing import MinMaxScaler
+from numpy.lib.stride_tricks import sliding_window_view
 
-from data.scats import ScatsData
-from utility import get_setting
+from data.scats import get_scats_data
+from utility import TIME_INTERVALS, convert_date_string_to_day, convert_dates_to_days_of_week, get_setting
 
-SCATS_DATA = ScatsData()
+# The number of days used for training when no split date is given (the rest are used for testing)
+TRAIN_DAYS = 21
+# Where the scaled series behind process_data are kept between runs
+PROCESSED_DIRECTORY = "data/cache/processed"
+# The number of scaled series kept in memory
+PROCESSED_CACHE_SIZE = 64
+# The fitted attributes of the MinMaxScaler that are saved with each series
+SCALER_ATTRIBUTES = ["min_", "scale_", "data_min_", "data_max_", "data_range_", "n_samples_seen_"]
 
 
 def format_time_to_index(time):
@@ -52,67 +63,257 @@ def format_date(date):
     return pd.datetime.strftime(date, "%d/%m/%Y")
 
 
-def process_data(scats_number, junction, lags):
+def get_first_test_day():
+    """ Gets the first day after the training days, counted by calendar day from the first day of the dataset
+
+    Returns:
+        datetime64: the day
+    """
+    return get_scats_data().get_days()[0] + np.timedelta64(TRAIN_DAYS, "D")
+
+
+def make_windows(flow, lags):
+    """ Views a series as overlapping windows of lags + 1 values, without copying it
+
+    Parameters:
+        flow (array): the series (or a series per row)
+        lags (int): time lag
+
+    Returns:
+        array: a read-only (samples x lags + 1) view, where the last column is the value being predicted
+            (with a leading axis for each row if several series were given)
+    """
+    if flow.shape[-1] <= lags:
+        return np.empty(flow.shape[:-1] + (0, lags + 1), dtype=flow.dtype)
+
+    return sliding_window_view(flow, lags + 1, axis=-1)
+
+
+def save_processed(filepath, flow1, flow2, scaler):
+    """ Writes a scaled series and its scaler into the processed data cache
+
+    Parameters:
+        filepath (String): the npz file
+        flow1 (array): the scaled training series
+        flow2 (array): the scaled testing series
+        scaler (MinMaxScaler): the scaler fitted to the training series
+    """
+    directory = os.path.dirname(filepath)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    temp_filepath = "{0}.{1}.tmp".format(filepath, os.getpid())
+    with open(temp_filepath, "wb") as f:
+        np.savez(f, flow1=flow1, flow2=flow2, feature_range=np.array(scaler.feature_range),
+                 **{name: np.asarray(getattr(scaler, name)) for name in SCALER_ATTRIBUTES})
+    os.replace(temp_filepath, filepath)
+
+
+def load_processed(filepath):
+    """ Reads a scaled series and its scaler from the processed data cache
+
+    Parameters:
+        filepath (String): the npz file
+
+    Returns:
+        array: the scaled training series
+        array: the scaled testing series
+        MinMaxScaler: the scaler fitted to the training series
+    """
+    # Imported here so that predicting with the saved scales never needs scikit-learn
+    from sklearn.preprocessing import MinMaxScaler
+
+    with np.load(filepath) as processed:
+        scaler = MinMaxScaler(feature_range=tuple(processed["feature_range"].tolist()))
+        for name in SCALER_ATTRIBUTES:
+            setattr(scaler, name, processed[name])
+        scaler.n_features_in_ = 1
+
+        return processed["flow1"], processed["flow2"], scaler
+
+
+@lru_cache(maxsize=PROCESSED_CACHE_SIZE)
+def get_scaled_series(scats_number, junction, start_date, end_date, split_date, version):
+    """ Splits and scales the volume of a location, from the processed data cache if it has been done before
+
+    Parameters:
+        scats_number (int): then number of the scats site
+        junction (int): the VicRoads internal id representing the location
+        start_date (String): the first day of data to use (None for the first day available)
+        end_date (String): the last day of data to use (None for the last day available)
+        split_date (String): the first day used for testing (None for the day after the first TRAIN_DAYS days)
+        version (String): the version of the site's data, so the cache is missed when the data changes
+
+    Returns:
+        array: the scaled training series (read-only)
+        array: the scaled testing series (read-only)
+        MinMaxScaler: the scaler fitted to the training series (None if there is no data)
+    """
+    key = json.dumps([str(scats_number), str(junction), start_date, end_date, split_date, version, TRAIN_DAYS])
+    # Named by location and data version so the files of older versions of the location's data can be found
+    prefix = "{0}-{1}-".format(scats_number, junction)
+    name = "{0}{1}-{2}.npz".format(prefix, version[:16], hashlib.sha1(key.encode("utf-8")).hexdigest())
+    filepath = os.path.join(PROCESSED_DIRECTORY, name)
+
+    if os.path.exists(filepath):
+        flow1, flow2, scaler = load_processed(filepath)
+    else:
+        scats_data = get_scats_data()
+        volume_data = scats_data.get_scats_volume(scats_number, junction, flat=True, start_date=start_date,
+                                                  end_date=end_date)
+        if not len(volume_data):
+            return volume_data, volume_data, None
+
+        if split_date is None:
+            # Training using the first 3 weeks.
+            split = TRAIN_DAYS * 96
+        else:
+            dates = scats_data.get_scats_dates(scats_number, junction, start_date, end_date)
+            split = int(np.searchsorted(dates, np.datetime64(split_date, "D"))) * 96
+        volume_training = volume_data[:split]
+        # Testing using the remaining days.
+        volume_testing = volume_data[split:]
+
+        from sklearn.preprocessing import MinMaxScaler
+
+        # scaler = StandardScaler().fit(volume.values)
+        # Fit training data between feature range (0-1) | Reshape array to be (unknown, 1)
+        scaler = MinMaxScaler(feature_range=(0, 1)).fit(volume_training.reshape(-1, 1))
+        flow1 = scaler.transform(volume_training.reshape(-1, 1)).reshape(-1)
+        flow2 = scaler.transform(volume_testing.reshape(-1, 1)).reshape(-1)
+
+        save_processed(filepath, flow1, flow2, scaler)
+
+        # Remove the series scaled from older versions of the location's data, which can never be used again
+        for old_filepath in glob.glob(os.path.join(PROCESSED_DIRECTORY, glob.escape(prefix) + "*.npz")):
+            if not os.path.basename(old_filepath).startswith(prefix + version[:16] + "-"):
+                os.remove(old_filepath)
+
+    # The arrays are shared by every caller
+    flow1.flags.writeable = False
+    flow2.flags.writeable = False
+
+    return flow1, flow2, scaler
+
+
+def process_data(scats_number, junction, lags, start_date=None, end_date=None, split_date=None, quiet=False):
     """Process the VicRoads data into a more readable format
 
     Parameters:
         scats_number (int): then number of the scats site
         junction (int): the VicRoads internal id representing the location
-        lags (int): time lag
+        lags (int/list<int>): time lag, or several time lags to build windows for from the same scaled data
+        start_date (String): the first day of data to use, e.g. "2006-10-01" (defaults to the first day available)
+        end_date (String): the last day of data to use (defaults to the last day available)
+        split_date (String): the first day used for testing (defaults to the day after the first TRAIN_DAYS days)
+        quiet (bool): don't print details of the data
 
     Returns:
         array: x_train
         array: y_train
-        array: x_test
-        array: y_test
+        array: x_test (a read-only view of the scaled data)
+        array: y_test (a read-only view of the scaled data)
         StandardScaler: the scaler used to reshape the training data
+        (or, when several lags are given, a dict of lag -> the values above)
     """
-    volume_data = SCATS_DATA.get_scats_volume(scats_number, junction)
-    if not len(volume_data):
+    version = get_scats_data().get_data_version(scats_number)
+    flow1, flow2, scaler = get_scaled_series(scats_number, junction, start_date, end_date, split_date, version)
+    if scaler is None:
+        if np.ndim(lags):
+            return {lag: ([], [], [], [], []) for lag in lags}
         return [], [], [], [], []
-    print(f"(data.py) VOLUME DATA: {volume_data[:10]}")
-    print(f"(data.py) VOLUME DATA SHAPE: {volume_data.shape}")
-    # Training using the first 3 weeks.
-    volume_training = volume_data[:2016]
-    # Testing using the remaining days of the month.
-    volume_testing = volume_data[2016:]
-
-    # scaler = StandardScaler().fit(volume.values)
-    # Fit training data between feature range (0-1) | Reshape array to be (unknown, 1)
-    scaler = MinMaxScaler(feature_range=(0, 1)).fit(volume_training.reshape(-1, 1))
-    print(f"(data.py) SCALER: {scaler}")
-    print(f"(data.py) SCALER TRAIN VOLUME SHAPE: {volume_training.reshape(-1, 1).shape}")
-    flow1 = scaler.transform(volume_training.reshape(-1, 1)).reshape(1, -1)[0]
-    print(f"(data.py) FLOW1 ELEMENTS: {flow1[:5]}")
-    print(f"(data.py) FLOW1 SHAPE: {flow1.shape}")
-    flow2 = scaler.transform(volume_testing.reshape(-1, 1)).reshape(1, -1)[0]
-    print(f"(data.py) FLOW2 ELEMENTS: {flow2[:5]}")
-    print(f"(data.py) FLOW2 SHAPE: {flow2.shape}")
-
-    print(f"(data.py) LAGS: {lags}")
-    print(f"(data.py) APPENDED DATA: {flow1[1000 - lags: 1000 + 1]}")
-    train, test = [], []
-    for i in range(lags, len(flow1)):
-        train.append(flow1[i - lags: i + 1])  # from i - lags to i + 1 -  Appending batches of 13 items?
-    for i in range(lags, len(flow2)):
-        test.append(flow2[i - lags: i + 1])
-
-    train = np.array(train)
-    test = np.array(test)
-    print(f"(data.py) TRAIN SHAPE: {train.shape}")
-    print(f"(data.py) TEST SHAPE: {test.shape}")
-
-    np.random.shuffle(train)  # Shuffle training data
-
-    x_train = train[:, :-1]  # Training data         Remove 1 as we're only interested in lags time steps
-    y_train = train[:, -1]  # Training labels       Drop right column so we're left with labels.
-    x_test = test[:, :-1]  # Testing data
-    y_test = test[:, -1]  # Testing labels
-
-    print(f"(data.py) XTRAIN SHAPE: {x_train.shape}")
-    print(f"(data.py) YTRAIN SHAPE: {y_train.shape}")
-
-    return x_train, y_train, x_test, y_test, scaler
+    if not quiet:
+        print(f"(data.py) SCALER: {scaler}")
+        print(f"(data.py) FLOW1 ELEMENTS: {flow1[:5]}")
+        print(f"(data.py) FLOW1 SHAPE: {flow1.shape}")
+        print(f"(data.py) FLOW2 ELEMENTS: {flow2[:5]}")
+        print(f"(data.py) FLOW2 SHAPE: {flow2.shape}")
+
+    results = {}
+    for lag in np.atleast_1d(lags).tolist():
+        train = make_windows(flow1, lag)
+        test = make_windows(flow2, lag)
+
+        # Shuffling the training data is the only copy made of the windows
+        train = train[np.random.permutation(len(train))]
+
+        x_train = train[:, :-1]  # Training data         Remove 1 as we're only interested in lags time steps
+        y_train = train[:, -1]  # Training labels       Drop right column so we're left with labels.
+        x_test = test[:, :-1]  # Testing data
+        y_test = test[:, -1]  # Testing labels
+
+        if not quiet:
+            print(f"(data.py) LAGS: {lag}")
+            print(f"(data.py) XTRAIN SHAPE: {x_train.shape}")
+            print(f"(data.py) XTEST SHAPE: {x_test.shape}")
+
+        results[lag] = x_train, y_train, x_test, y_test, scaler
+
+    if np.ndim(lags):
+        return results
+
+    return results[lags]
+
+
+def process_batch(junctions, lags, start_date=None, end_date=None, split_date=None, shuffle=True):
+    """ Builds the windows for many locations at once, scaling each location the same way as process_data
+
+    The volumes of every location are read into one matrix aligned by date, so unlike process_data every location is
+    split at the same day. Days a location has no data for are left out of its scale, and the windows that touch
+    them are marked as invalid (their values are NaN).
+
+    Parameters:
+        junctions (list<tuple>): the (scats_number, location) pairs, or None for every location (in the order of
+            ScatsData.get_junctions)
+        lags (int): time lag
+        start_date (String): the first day of data to use, e.g. "2006-10-01" (defaults to the first day available)
+        end_date (String): the last day of data to use (defaults to the last day available)
+        split_date (String): the first day used for testing (defaults to the day after the first TRAIN_DAYS days)
+        shuffle (bool): shuffle the training windows (in the same order for every location)
+
+    Returns:
+        array: x_train (junctions x windows x lags)
+        array: y_train (junctions x windows)
+        array: x_test (junctions x windows x lags, a read-only view of the scaled data)
+        array: y_test (junctions x windows, a read-only view of the scaled data)
+        array: the (junctions x 2) minimum and range of the training volumes used to scale each location, so that
+            volume = scaled * range + minimum
+        array: (junctions x windows) whether each training window only covers days the location has data for
+        array: (junctions x windows) whether each testing window only covers days the location has data for
+    """
+    scats_data = get_scats_data()
+    volume_data = scats_data.get_scats_volumes(junctions, fill_value=np.nan, start_date=start_date, end_date=end_date,
+                                               dtype=np.float64)
+
+    if split_date is None:
+        # Training using the first 3 weeks.
+        split = TRAIN_DAYS
+    else:
+        days = scats_data.get_days(start_date, end_date)
+        split = int(np.searchsorted(days, np.datetime64(split_date, "D")))
+    volume_data = volume_data.reshape(len(volume_data), -1)
+    volume_training = volume_data[:, :split * 96]
+    # Testing using the remaining days.
+    volume_testing = volume_data[:, split * 96:]
+
+    # Fit training data between feature range (0-1), the same as a MinMaxScaler fitted to each location
+    scales = np.zeros((len(volume_data), 2))
+    has_training = ~np.isnan(volume_training).all(axis=1)
+    scales[has_training, 0] = np.nanmin(volume_training[has_training], axis=1)
+    scales[has_training, 1] = np.nanmax(volume_training[has_training], axis=1) - scales[has_training, 0]
+    scales[scales[:, 1] == 0, 1] = 1
+    flow1 = (volume_training - scales[:, :1]) / scales[:, 1:]
+    flow2 = (volume_testing - scales[:, :1]) / scales[:, 1:]
+    flow2.flags.writeable = False
+
+    train = make_windows(flow1, lags)
+    test = make_windows(flow2, lags)
+    if shuffle:
+        train = train[:, np.random.permutation(train.shape[1])]
+    valid_train = ~np.isnan(train).any(axis=-1)
+    valid_test = ~np.isnan(test).any(axis=-1)
+
+    return train[..., :-1], train[..., -1], test[..., :-1], test[..., -1], scales, valid_train, valid_test
 
 
 def get_distance_between_points(o_scats, o_junction, d_scats, d_junction):
@@ -125,31 +326,17 @@ def get_distance_between_points(o_scats, o_junction, d_scats, d_junction):
         d_junction (int): the destination
 
     Returns:
-        int: the distance in km between the two points
+        float: the distance in km between the two points
     """
-    # The earth's volumetric mean radius
-    earth_radius = 6371
-
-    o_latitude, o_longitude = SCATS_DATA.get_positional_data(o_scats, o_junction)
-    d_latitude, d_longitude = SCATS_DATA.get_positional_data(d_scats, d_junction)
+    scats_data = get_scats_data()
+    origin = scats_data.junction_index[(int(o_scats), int(o_junction))]
+    destination = scats_data.junction_index[(int(d_scats), int(d_junction))]
 
-    # Converts all the values into radians
-    o_latitude, o_longitude, d_latitude, d_longitude = \
-        map(np.radians, (o_latitude, o_longitude, d_latitude, d_longitude))
-
-    # Gets the difference between latitude and longitude values
-    dist_latitude = d_latitude - o_latitude
-    dist_longitude = d_longitude - o_longitude
-
-    # Applies the haversine formula
-    h = np.sin(dist_latitude / 2) ** 2 + np.cos(o_latitude) * np.cos(d_latitude) * np.sin(
-        dist_longitude / 2) ** 2
-
-    return 2 * earth_radius * asin(np.sqrt(h))
+    return float(scats_data.get_distance_matrix()[origin, destination])
 
 
 def get_time_between_points(o_scats, o_junction, d_scats, d_junction, time):
-    """ Finds the time it would take to travel between two points
+    """ Finds the time it would take to travel between two points, on the first day after the training days
 
     Parameters:
         o_scats (int): the origin scats site
@@ -161,23 +348,77 @@ def get_time_between_points(o_scats, o_junction, d_scats, d_junction, time):
     Returns:
         float: the time in minutes to travel from one location to another
     """
-    result = 0
+    return float(get_travel_times([[o_scats, o_junction, d_scats, d_junction]], TIME_INTERVALS[time])[0, 0])
+
+
+def predict_volumes(junctions, network_type, generalised=False, date=None, lookup=False):
+    """ Predicts the volume of many locations for every time of day
+
+    Both models predict the day of the week of the date. Each location's own model predicts it from the first day of
+    the location's data on that day of the week after the training days, whether the forecasts are looked up or not.
+
+    Parameters:
+        junctions (list<tuple>): the (scats_number, location) pairs
+        network_type (String): the type of model to use, e.g. "lstm"
+        generalised (bool): predict every location with one pass of the generalised model rather than each
+            location's own model
+        date (String): the day to predict, e.g. "23/10/2019" (defaults to the first day after the training days)
+        lookup (bool): read the forecasts from the precomputed tables (see forecast.py), only running the models for
+            forecasts that are missing or out of date
+
+    Returns:
+        array: the (junctions x 96) predicted volumes, NaN for locations that could not be predicted
+    """
+    # Imported here as the predictor depends on this module
+    from predictor import Predictor
+
+    day = get_first_test_day() if date is None else convert_date_string_to_day(date)
+    model_file = "model/{0}/Generalised/Model.h5".format(network_type) if generalised else None
+
+    predictor = Predictor(model_file, network_type, lookup=lookup)
+    return predictor.forecast_volumes(junctions, int(convert_dates_to_days_of_week(day)), generalised)
+
+
+def get_travel_times(edges, times=None, network_type=None, generalised=False, date=None, lookup=False):
+    """ Finds the time it would take to travel many sections of road, at one or more times of day
+
+    Each location's volumes are predicted once for the whole day, so a model is only run once per origin (or once
+    in total for the generalised model) however many roads and times are asked for.
+
+    Parameters:
+        edges (array): (edges x 4) origin site, origin location, destination site and destination location of each
+            road, e.g. from Location.get_edge_array
+        times (int/list<int>): the 15 minute intervals of the day (0-95) to estimate for (None for all 96)
+        network_type (String): the type of model to use (defaults to the "model" setting)
+        generalised (bool): use the generalised model rather than each location's own model
+        date (String): the day to predict, e.g. "23/10/2019" (defaults to the first day after the training days)
+        lookup (bool): read the volumes from the precomputed forecast tables where they are current
+
+    Returns:
+        array: the (edges x times) travel times, 0 where the time could not be estimated
+    """
     delay = 1 / 3600
 
-    model_name = get_setting["model"]
-    try:
-        predictor = Predictor(None, model_name)
-        volume = predictor.make_prediction_from_individual(o_scats, o_junction, time)
+    edges = np.asarray(edges, dtype=np.int64).reshape(-1, 4)
+    times = np.arange(96) if times is None else np.atleast_1d(times)
+    if network_type is None:
+        network_type = get_setting("model").lower()
 
-        distance = get_distance_between_points(o_scats, o_junction, d_scats, d_junction)
-        speed_limit = SCATS_DATA.get_speed_limit(o_scats, o_junction, d_scats, d_junction)
+    scats_data = get_scats_data()
+    origins, origin_index = np.unique(edges[:, :2], axis=0, return_inverse=True)
+    volumes = predict_volumes([tuple(origin) for origin in origins.tolist()], network_type, generalised, date, lookup)
+    volume = volumes[origin_index.reshape(-1)][:, times]
 
+    distance = scats_data.get_distances(edges)[:, np.newaxis]
+    speed_limit = scats_data.get_speed_limits(edges)[:, np.newaxis]
+
+    with np.errstate(divide="ignore", invalid="ignore"):
         flow = volume * 4
         density = volume / distance
         travel_speed = flow / density
 
-        result = distance / min(travel_speed, speed_limit) + delay
-    except ValueError:
-        pass
+        result = distance / np.minimum(travel_speed, speed_limit) + delay
+
+    result[~np.isfinite(result)] = 0
 
     return result
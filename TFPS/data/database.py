@@ -0,0 +1,165 @@
+import json
+import sqlite3
+import threading
+
+import numpy as np
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS metadata (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sites (
+    site INTEGER PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS approaches (
+    site INTEGER NOT NULL REFERENCES sites (site),
+    location INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    latitude REAL NOT NULL,
+    longitude REAL NOT NULL,
+    PRIMARY KEY (site, location)
+);
+CREATE TABLE IF NOT EXISTS volumes (
+    site INTEGER NOT NULL,
+    location INTEGER NOT NULL,
+    date TEXT NOT NULL,
+    volume BLOB NOT NULL,
+    PRIMARY KEY (site, location, date),
+    FOREIGN KEY (site, location) REFERENCES approaches (site, location)
+);
+CREATE INDEX IF NOT EXISTS approaches_name ON approaches (name);
+"""
+
+# Each day of volumes is stored as a blob of 96 little-endian 32 bit integers
+VOLUME_TYPE = np.dtype("<i4")
+
+
+def format_day(date):
+    """ Converts a date into the ISO format used for the date column
+
+    Parameters:
+        date (datetime64/String): the date
+
+    Returns:
+        String: the date in the format of 2006-10-01
+    """
+    return str(np.datetime64(date, "D"))
+
+
+class ScatsDatabase(object):
+    """ Stores the VicRoads data in SQLite so it can be range-queried without loading the whole dataset
+
+    The database uses write-ahead logging, so any number of processes can read it while it is being updated.
+    """
+
+    def __init__(self, filepath):
+        """
+        Parameters:
+            filepath (String): the SQLite database file
+        """
+        self.filepath = filepath
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(filepath, timeout=30, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        with self.connection:
+            self.connection.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """ Closes the connection to the database """
+        self.connection.close()
+
+    def get_metadata(self, key, default=None):
+        """ Reads a value stored alongside the data
+
+        Parameters:
+            key (String): the name of the value
+            default (object): the value returned if it has not been stored
+
+        Returns:
+            object: the (JSON decoded) value
+        """
+        with self.lock:
+            row = self.connection.execute("SELECT value FROM metadata WHERE key = ?", (key,)).fetchone()
+
+        return default if row is None else json.loads(row[0])
+
+    def set_metadata(self, key, value):
+        """ Stores a value alongside the data
+
+        Parameters:
+            key (String): the name of the value
+            value (object): the (JSON serialisable) value
+        """
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO metadata (key, value) VALUES (?, ?)",
+                                    (key, json.dumps(value)))
+
+    def ingest(self, columns, replace=True):
+        """ Bulk loads the dataset
+
+        Parameters:
+            columns (dict): the arrays for each of the store columns (see data.store.COLUMNS)
+            replace (bool): remove the existing data first
+        """
+        sites = np.asarray(columns["sites"])
+        locations = np.asarray(columns["locations"])
+        volumes = np.asarray(columns["volumes"], dtype=VOLUME_TYPE)
+        dates = np.asarray(columns["dates"]).astype("datetime64[D]").astype(str)
+
+        # The first row of each (site, location) describes the approach
+        _, first_rows = np.unique(np.stack((sites, locations), axis=1), axis=0, return_index=True)
+
+        with self.lock, self.connection:
+            if replace:
+                self.connection.execute("DELETE FROM volumes")
+                self.connection.execute("DELETE FROM approaches")
+                self.connection.execute("DELETE FROM sites")
+
+            self.connection.executemany("INSERT OR IGNORE INTO sites (site) VALUES (?)",
+                                        ((int(site),) for site in np.unique(sites)))
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO approaches (site, location, name, latitude, longitude) VALUES (?, ?, ?, ?, ?)",
+                ((int(sites[i]), int(locations[i]), str(columns["names"][i]), float(columns["latitudes"][i]),
+                  float(columns["longitudes"][i])) for i in first_rows))
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO volumes (site, location, date, volume) VALUES (?, ?, ?, ?)",
+                ((int(sites[i]), int(locations[i]), dates[i], volumes[i].tobytes()) for i in range(len(sites))))
+
+    def get_scats_volume(self, scats_number, location, start_date=None, end_date=None):
+        """ Gets the volume for a location over a range of days
+
+        Parameters:
+            scats_number (int): the scats site identifier
+            location (int): the VicRoads internal id/direction for the location
+            start_date (datetime64/String): the first day to include (defaults to the first day available)
+            end_date (datetime64/String): the last day to include (defaults to the last day available)
+
+        Returns:
+            array: the days the volumes were recorded on
+            array: the (days x 96) volumes
+        """
+        query = "SELECT date, volume FROM volumes WHERE site = ? AND location = ?"
+        parameters = [int(scats_number), int(location)]
+        if start_date is not None:
+            query += " AND date >= ?"
+            parameters.append(format_day(start_date))
+        if end_date is not None:
+            query += " AND date <= ?"
+            parameters.append(format_day(end_date))
+        query += " ORDER BY date"
+
+        with self.lock:
+            rows = self.connection.execute(query, parameters).fetchall()
+
+        dates = np.array([row[0] for row in rows], dtype="datetime64[D]")
+        volumes = np.frombuffer(b"".join(row[1] for row in rows), dtype=VOLUME_TYPE).reshape(-1, 96)
+
+        return dates, volumes
@@ -0,0 +1,447 @@
+import asyncio
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import overpass as op
+
+OVERPASS_ENDPOINT = "https://lz4.overpass-api.de/api/interpreter"
+
+# The OpenStreetMap fields that may hold the name of a road
+NAME_FIELDS = ["name", "alt-name"]
+
+# The errors that are worth sending a query again for (connection errors from requests are OSErrors)
+RETRY_ERRORS = (op.errors.MultipleRequestsError, op.errors.ServerLoadError, op.errors.TimeoutError,
+                op.errors.ServerRuntimeError, op.errors.UnknownOverpassError, OSError)
+
+
+def parse_speed_limit(maxspeed):
+    """ Converts an OpenStreetMap maxspeed value into km/h
+
+    Parameters:
+        maxspeed (String): the value of the maxspeed tag, e.g. "60" or "40 mph"
+
+    Returns:
+        int: the speed limit (in km/h), or None if the value is not a number
+    """
+    parts = str(maxspeed).split()
+    try:
+        speed_limit = float(parts[0])
+    except (IndexError, ValueError):
+        return None
+
+    if len(parts) > 1 and parts[1] == "mph":
+        speed_limit *= 1.609344
+
+    return int(round(speed_limit))
+
+
+def bounding_box(s_latitude, s_longitude, e_latitude, e_longitude):
+    """ Gets the box around two points in the (south, west, north, east) order used by Overpass
+
+    Parameters:
+        s_latitude (float): the latitude of the first point
+        s_longitude (float): the longitude of the first point
+        e_latitude (float): the latitude of the second point
+        e_longitude (float): the longitude of the second point
+
+    Returns:
+        tuple: the south, west, north and east edges of the box
+    """
+    return (min(s_latitude, e_latitude), min(s_longitude, e_longitude),
+            max(s_latitude, e_latitude), max(s_longitude, e_longitude))
+
+
+def intersects(feature, bbox):
+    """ Checks whether any point of a feature lies inside a bounding box
+
+    Parameters:
+        feature (dict): the GeoJSON feature
+        bbox (tuple): the south, west, north and east edges of the box
+
+    Returns:
+        bool: True if the feature passes through the box
+    """
+    south, west, north, east = bbox
+    geometry = feature.get("geometry") or {}
+    coordinates = geometry.get("coordinates") or []
+    if geometry.get("type") == "Point":
+        coordinates = [coordinates]
+
+    return any(south <= point[1] <= north and west <= point[0] <= east for point in coordinates)
+
+
+def find_speed_limit(features, name, default):
+    """ Finds the speed limit of the road with a given name in an Overpass response
+
+    Parameters:
+        features (list<dict>): the GeoJSON features
+        name (String): the full name of the road, e.g. "Warrigal Road"
+        default (int): the speed limit returned if the road has none
+
+    Returns:
+        int: the speed limit of the road (in km/h)
+    """
+    speed_limit = default
+    for feature in features:
+        properties = feature.get("properties", {})
+        # Newer versions of overpass nest the OpenStreetMap tags rather than merging them into the properties
+        tags = properties.get("tags", properties)
+
+        for name_field in NAME_FIELDS:
+            if tags.get(name_field) == name and "maxspeed" in tags:
+                speed_limit = parse_speed_limit(tags["maxspeed"]) or speed_limit
+
+    return speed_limit
+
+
+class TokenBucket(object):
+    """ Limits how often requests are started, allowing short bursts """
+
+    def __init__(self, rate, capacity):
+        """
+        Parameters:
+            rate (float): the number of tokens added each second
+            capacity (float): the most tokens that can be saved up
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        """ Waits until a token is available and takes it """
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class AsyncOverpassClient(object):
+    """ Sends Overpass queries concurrently under a rate limit
+
+    The requests run on an event loop in a background thread, so identical queries are only ever sent once at a
+    time no matter which thread asks for them. get and get_many block until the responses arrive.
+    """
+
+    def __init__(self, endpoint=OVERPASS_ENDPOINT, timeout=60, concurrency=4, rate=1.0, burst=2, retries=3,
+                 backoff=2.0):
+        """
+        Parameters:
+            endpoint (String): the URL of the Overpass interpreter
+            timeout (int): the number of seconds to wait for a response
+            concurrency (int): the most requests that can be waiting on the endpoint at once
+            rate (float): the number of requests started per second (on average)
+            burst (int): the number of requests that can be started at once after a quiet period
+            retries (int): the number of times a failed request is sent again
+            backoff (float): the number of seconds waited before the first retry (doubled for each retry after)
+        """
+        self.endpoint = endpoint
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.bucket = TokenBucket(rate, burst)
+
+        # Query -> the task requesting it, for every query that has been sent but not answered
+        self.in_flight = {}
+        self.semaphore = None
+        self.loop = None
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def get_loop(self):
+        """ Starts the event loop thread (the first time only)
+
+        Returns:
+            AbstractEventLoop: the loop the requests run on
+        """
+        with self.lock:
+            if self.loop is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.concurrency)
+                self.loop = asyncio.new_event_loop()
+                threading.Thread(target=self.loop.run_forever, daemon=True).start()
+
+        return self.loop
+
+    def close(self):
+        """ Stops the event loop thread """
+        with self.lock:
+            if self.loop is not None:
+                self.loop.call_soon_threadsafe(self.loop.stop)
+                self.executor.shutdown(wait=False)
+                self.loop = None
+                self.executor = None
+                self.semaphore = None
+
+    def request(self, query):
+        """ Sends a query to the endpoint (blocking)
+
+        Parameters:
+            query (String): the Overpass query
+
+        Returns:
+            dict: the GeoJSON response
+        """
+        api = op.API(endpoint=self.endpoint, timeout=self.timeout)
+
+        return api.get(query, verbosity='geom')
+
+    async def send(self, query):
+        """ Sends a query, retrying with exponential backoff if the endpoint is busy or unreachable
+
+        Parameters:
+            query (String): the Overpass query
+
+        Returns:
+            dict: the GeoJSON response
+        """
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+
+        loop = asyncio.get_running_loop()
+        for attempt in range(self.retries + 1):
+            try:
+                async with self.semaphore:
+                    await self.bucket.acquire()
+                    return await loop.run_in_executor(self.executor, self.request, query)
+            except RETRY_ERRORS:
+                if attempt == self.retries:
+                    raise
+
+            await asyncio.sleep(self.backoff * 2 ** attempt * random.uniform(0.5, 1.5))
+
+    async def fetch(self, query):
+        """ Gets the response to a query, joining the request already in flight if there is one
+
+        Parameters:
+            query (String): the Overpass query
+
+        Returns:
+            dict: the GeoJSON response
+        """
+        task = self.in_flight.get(query)
+        if task is None:
+            task = asyncio.ensure_future(self.send(query))
+            self.in_flight[query] = task
+            task.add_done_callback(lambda _: self.in_flight.pop(query, None))
+
+        return await task
+
+    async def fetch_all(self, queries):
+        """ Gets the responses to many queries concurrently
+
+        Parameters:
+            queries (list<String>): the Overpass queries
+
+        Returns:
+            list: the GeoJSON response (or the error raised) for each query
+        """
+        return await asyncio.gather(*(self.fetch(query) for query in queries), return_exceptions=True)
+
+    def get_many(self, queries):
+        """ Gets the responses to many queries concurrently (blocking)
+
+        Parameters:
+            queries (list<String>): the Overpass queries
+
+        Returns:
+            list: the GeoJSON response (or the error raised) for each query
+        """
+        return asyncio.run_coroutine_threadsafe(self.fetch_all(queries), self.get_loop()).result()
+
+    def get(self, query):
+        """ Gets the response to a query (blocking)
+
+        Parameters:
+            query (String): the Overpass query
+
+        Returns:
+            dict: the GeoJSON response
+        """
+        response = self.get_many([query])[0]
+        if isinstance(response, Exception):
+            raise response
+
+        return response
+
+
+class OsmSpeedLimits(object):
+    """ Looks up speed limits from OpenStreetMap, keeping every Overpass response in an on-disk cache
+
+    The endpoint can be any Overpass compatible server (such as a local stand-in), and with offline set only the
+    cache is used, so a directory of saved responses can stand in for the network entirely.
+    """
+
+    def __init__(self, cache_directory, endpoint=OVERPASS_ENDPOINT, timeout=60, offline=False, concurrency=4,
+                 rate=1.0):
+        """
+        Parameters:
+            cache_directory (String): the directory the responses are cached in
+            endpoint (String): the URL of the Overpass interpreter
+            timeout (int): the number of seconds to wait for a response
+            offline (bool): never query the endpoint, roads missing from the cache get the default speed limit
+            concurrency (int): the most queries that can be sent at once
+            rate (float): the number of queries started per second (on average)
+        """
+        self.cache_directory = cache_directory
+        self.offline = offline
+        self.client = AsyncOverpassClient(endpoint, timeout, concurrency=concurrency, rate=rate)
+
+        # The ways of the whole road network, once prefetched
+        self.network = None
+        self.lock = threading.Lock()
+
+    def close(self):
+        """ Stops the client's event loop thread """
+        self.client.close()
+
+    def get_cache_file(self, query):
+        """ Gets the file a query's response is cached in
+
+        Parameters:
+            query (String): the Overpass query
+
+        Returns:
+            String: the file path
+        """
+        key = hashlib.sha1(query.encode("utf-8")).hexdigest()
+
+        return os.path.join(self.cache_directory, key + ".json")
+
+    def get(self, query):
+        """ Gets the response to a query, from the cache if it has been seen before
+
+        Parameters:
+            query (String): the Overpass query
+
+        Returns:
+            dict: the GeoJSON response, or None if offline and the query is not cached
+        """
+        return self.get_many([query])[query]
+
+    def get_many(self, queries):
+        """ Gets the responses to many queries, sending the ones that are not cached concurrently
+
+        Parameters:
+            queries (list<String>): the Overpass queries
+
+        Returns:
+            dict: query -> the GeoJSON response, or None if offline and the query is not cached
+        """
+        responses = {}
+        missing = []
+        for query in dict.fromkeys(queries):
+            cache_file = self.get_cache_file(query)
+            if os.path.exists(cache_file):
+                with open(cache_file, "r") as f:
+                    responses[query] = json.load(f)
+            elif self.offline:
+                responses[query] = None
+            else:
+                missing.append(query)
+
+        errors = []
+        for query, data in zip(missing, self.client.get_many(missing) if missing else []):
+            if isinstance(data, Exception):
+                errors.append(data)
+            else:
+                self.save(self.get_cache_file(query), data)
+                responses[query] = data
+
+        # Everything that did arrive is cached, so only the failed queries are sent next time
+        if errors:
+            raise errors[0]
+
+        return responses
+
+    def save(self, cache_file, data):
+        """ Writes a response into the cache
+
+        Parameters:
+            cache_file (String): the file to write to
+            data (dict): the GeoJSON response
+        """
+        if not os.path.exists(self.cache_directory):
+            os.makedirs(self.cache_directory)
+
+        temp_filepath = "{0}.{1}.{2}.tmp".format(cache_file, os.getpid(), threading.get_ident())
+        with open(temp_filepath, "w") as f:
+            json.dump(data, f)
+        os.replace(temp_filepath, cache_file)
+
+    def prefetch(self, bbox):
+        """ Downloads every named road in an area with a single query, so lookups inside it need no network
+
+        Parameters:
+            bbox (tuple): the south, west, north and east edges of the area
+        """
+        query = 'way["name"]({0},{1},{2},{3});(._;>;)'.format(*bbox)
+        data = self.get(query)
+
+        with self.lock:
+            self.network = None if data is None else data["features"]
+
+    @staticmethod
+    def get_query(road_name, bbox):
+        """ Builds the query for the ways of a road within a box
+
+        Parameters:
+            road_name (String): the name of the road (without the road type), e.g. "Warrigal"
+            bbox (tuple): the south, west, north and east edges of the box
+
+        Returns:
+            String: the Overpass query
+        """
+        return 'way["name"~"{0}"]({1},{2},{3},{4});(._;>;)'.format(road_name, *bbox)
+
+    def get_speed_limit(self, road_name, name, bbox, default):
+        """ Gets the speed limit of a section of road
+
+        Parameters:
+            road_name (String): the name of the road (without the road type), e.g. "Warrigal"
+            name (String): the full name of the road, e.g. "Warrigal Road"
+            bbox (tuple): the south, west, north and east edges of the section of road
+            default (int): the speed limit returned if the road has none
+
+        Returns:
+            int: the speed limit of the road (in km/h)
+        """
+        return self.get_speed_limits([(road_name, name, bbox)], default)[0]
+
+    def get_speed_limits(self, roads, default):
+        """ Gets the speed limits of many sections of road, sending any queries needed concurrently
+
+        Parameters:
+            roads (list<tuple>): the road name, full name and bounding box of each section of road
+            default (int): the speed limit returned for roads that have none
+
+        Returns:
+            list<int>: the speed limit of each road (in km/h)
+        """
+        with self.lock:
+            network = self.network
+
+        if network is not None:
+            return [find_speed_limit([feature for feature in network if intersects(feature, bbox)], name, default)
+                    for _, name, bbox in roads]
+
+        queries = [self.get_query(road_name, bbox) for road_name, _, bbox in roads]
+        responses = self.get_many(queries)
+
+        speed_limits = []
+        for query, (_, name, _) in zip(queries, roads):
+            data = responses[query]
+            speed_limits.append(find_speed_limit([] if data is None else data["features"], name, default))
+
+        return speed_limits
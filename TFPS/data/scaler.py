@@ -0,0 +1,70 @@
+import numpy as np
+
+
+class Scaler(object):
+    """ Scales volumes into the range 0-1 and back, the same as a fitted MinMaxScaler but with only NumPy
+
+    The minimum and range can be single values or arrays, in which case they are broadcast against the values
+    (e.g. a column of per-junction values for a (junctions x samples) array).
+    """
+
+    def __init__(self, minimum, data_range):
+        """
+        Parameters:
+            minimum (float/array): the smallest training volume
+            data_range (float/array): the difference between the largest and smallest training volumes
+        """
+        self.minimum = np.asarray(minimum, dtype=np.float64)
+        self.data_range = np.asarray(data_range, dtype=np.float64)
+
+    @classmethod
+    def fit(cls, values, axis=None):
+        """ Finds the scale of a set of volumes
+
+        Parameters:
+            values (array): the training volumes
+            axis (int): the axis to find the scale along (None for a single scale for all the values)
+
+        Returns:
+            Scaler: the scaler
+        """
+        values = np.asarray(values, dtype=np.float64)
+        minimum = values.min(axis=axis, keepdims=axis is not None)
+        data_range = values.max(axis=axis, keepdims=axis is not None) - minimum
+
+        # A constant series is left unscaled, as the MinMaxScaler does
+        return cls(minimum, np.where(data_range == 0, 1, data_range))
+
+    @classmethod
+    def from_sklearn(cls, scaler):
+        """ Copies the scale of a fitted (0-1) MinMaxScaler
+
+        Parameters:
+            scaler (MinMaxScaler): the fitted scaler
+
+        Returns:
+            Scaler: the scaler
+        """
+        return cls(np.squeeze(scaler.data_min_), 1 / np.squeeze(scaler.scale_))
+
+    def transform(self, values):
+        """ Scales volumes into the range 0-1
+
+        Parameters:
+            values (array): the volumes
+
+        Returns:
+            array: the scaled values
+        """
+        return (np.asarray(values, dtype=np.float64) - self.minimum) / self.data_range
+
+    def inverse_transform(self, values):
+        """ Converts scaled values back into volumes
+
+        Parameters:
+            values (array): the scaled values
+
+        Returns:
+            array: the volumes
+        """
+        return np.asarray(values, dtype=np.float64) * self.data_range + self.minimum
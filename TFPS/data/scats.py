@@ -1,13 +1,22 @@
+import glob
 import os.path
-from datetime import datetime
+import threading
+from collections import OrderedDict
 
 import numpy as np
-import overpass as op
 import pandas as pd
-import unicodecsv
-import xlrd
 
 import utility
+from data import store
+from data.database import ScatsDatabase
+from data.osm import OVERPASS_ENDPOINT, OsmSpeedLimits, bounding_box
+
+# The earth's volumetric mean radius (in km)
+EARTH_RADIUS = 6371
+
+# The dataset shared by the whole process, created on first use by get_scats_data
+SHARED_SCATS_DATA = None
+SHARED_SCATS_DATA_LOCK = threading.Lock()
 
 
 def check_data_exists():
@@ -15,43 +24,66 @@ def check_data_exists():
     return os.path.exists("Scats Data.csv")
 
 
-def format_date(column):
-    """ Converts a column of dates into the d/m/Y format with caching for performance.
+def to_day(date):
+    """ Converts a date into a datetime64 day
 
     Parameters:
-        column (DataFrame): the column of dates
+        date (datetime64/String): the date, e.g. "2006-10-03" (or None)
 
     Returns:
-        DataFrame: the converted dates column
+        datetime64: the day, or None if no date was given
     """
-    dates = {date: pd.datetime.strftime(datetime(*xlrd.xldate_as_tuple(
-        date, 0)), "%d/%m/%Y") for date in column}
-    return column.map(dates)
+    return None if date is None else np.datetime64(date, "D")
 
 
-def convert_to_csv(input_name, output_name):
-    """ Converts an xls spreadsheet into a csv file
+def haversine(o_latitude, o_longitude, d_latitude, d_longitude):
+    """ Finds the great-circle distance between points, for any (broadcastable) arrays of coordinates
 
     Parameters:
-        input_name (String): the file name for the data to be loaded
-        output_name (String): the file name for the output csv
+        o_latitude (float/array): the latitude of the origins
+        o_longitude (float/array): the longitude of the origins
+        d_latitude (float/array): the latitude of the destinations
+        d_longitude (float/array): the longitude of the destinations
+
+    Returns:
+        array: the distances in km
     """
-    spreadsheet = xlrd.open_workbook(input_name).sheet_by_index(1)
+    # Converts all the values into radians
+    o_latitude, o_longitude, d_latitude, d_longitude = \
+        map(np.radians, (o_latitude, o_longitude, d_latitude, d_longitude))
+
+    # Applies the haversine formula
+    h = np.sin((d_latitude - o_latitude) / 2) ** 2 + np.cos(o_latitude) * np.cos(d_latitude) * np.sin(
+        (d_longitude - o_longitude) / 2) ** 2
+
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(h, 1)))
 
-    file = open(output_name, "wb")
-    data = unicodecsv.writer(file, encoding="latin-1")
 
-    for n in range(2, spreadsheet.nrows):
-        data.writerow(spreadsheet.row_values(n))
+def get_scats_data():
+    """ Gets the dataset shared by every module, loading it the first time it is needed
 
-    file.close()
+    Returns:
+        ScatsData: the shared dataset
+    """
+    global SHARED_SCATS_DATA
+
+    if SHARED_SCATS_DATA is None:
+        with SHARED_SCATS_DATA_LOCK:
+            if SHARED_SCATS_DATA is None:
+                SHARED_SCATS_DATA = ScatsData()
+
+    return SHARED_SCATS_DATA
 
 
 class ScatsData(object):
     """ Stores and retrieves the VicRoads data """
-    DATA_SOURCE = "data/Scats Data October 2006.xls"
+    # One workbook per month, e.g. "Scats Data October 2006.xls"
+    DATA_SOURCES = "data/Scats Data *.xls"
     CSV_FILE = "data/Scats Data.csv"
+    CACHE_DIRECTORY = "data/cache"
+    DATABASE_FILE = os.path.join("data", utility.get_setting("database"))
     MAPPING_DATA = "data/MappingData.xls"
+    OSM_CACHE_DIRECTORY = "data/osm"
 
     CONVENTIONS = {"RD": "Road",
                    "ST": "Street",
@@ -66,17 +98,34 @@ class ScatsData(object):
     COS_TIMES = np.empty((96,))
 
     MAX_TRAFFIC = 1000
+    # The number of edge lists whose speed limit arrays are kept
+    SPEED_LIMIT_ARRAYS = 8
 
     DEFAULT_SPEED_LIMIT = 60
     USE_SPEED_LIMITS_FROM_OSM = False
+    # The Overpass server used for the OpenStreetMap speed limits (can be a local stand-in)
+    OSM_ENDPOINT = OVERPASS_ENDPOINT
+    # Only use the cached OpenStreetMap responses, never the network
+    OSM_OFFLINE = False
+    # The most OpenStreetMap queries sent at once, and how many are started per second
+    OSM_CONCURRENCY = 4
+    OSM_REQUESTS_PER_SECOND = 1.0
+
+    # Compare the source files by content rather than modification time when checking the cache
+    VALIDATE_CACHE_BY_HASH = False
+    # Answer date range queries from the SQLite database rather than the columnar cache
+    USE_DATABASE = False
 
     def __init__(self):
-        # Load all the SCATS data
-        if not os.path.exists(self.CSV_FILE):
-            convert_to_csv(self.DATA_SOURCE, self.CSV_FILE)
-        dataset = pd.read_csv(self.CSV_FILE, encoding="latin-1", sep=",", header=None)
-        self.data = pd.DataFrame(dataset)
-        self.data[9] = format_date(self.data[9])
+        # Open the columnar cache (rebuilding it if the source has changed), the partitions are loaded on first use
+        if not store.is_store_current(self.CACHE_DIRECTORY, self.get_sources(), self.VALIDATE_CACHE_BY_HASH):
+            self.build_cache()
+        self.columns_lock = threading.Lock()
+        self.distances_lock = threading.Lock()
+        self.open_cache()
+
+        self.database = None
+        self.database_lock = threading.Lock()
 
         for i in range(8):
             self.DIRECTIONS_SINE[i] = 0.5 * np.sin(2 * np.pi * i / 8) + 0.5
@@ -85,37 +134,356 @@ class ScatsData(object):
             self.SIN_TIMES[i] = 0.5 * np.sin(2 * np.pi * i / 96) + 0.5
             self.COS_TIMES[i] = 0.5 * np.cos(2 * np.pi * i / 96) + 0.5
 
-        self.roads = pd.DataFrame(columns=["0", "1", "2", "3", "4"])
-        if not self.USE_SPEED_LIMITS_FROM_OSM and os.path.exists(self.MAPPING_DATA):
-            roads_data = pd.read_excel(self.MAPPING_DATA, sheet_name='NodeConnections', skiprows=1)
-            self.roads = pd.DataFrame(roads_data)
+        # (start site, start location, end site, end location) -> speed limit, read from the mapping data when needed
+        self.speed_limits = None
+        self.speed_limits_lock = threading.Lock()
+        # The dense speed limit arrays of the edge lists asked for, (source, edges) -> read-only array aligned to the
+        # edge ids, most recently used last
+        self.speed_limit_arrays = OrderedDict()
+        # The OpenStreetMap lookup and the settings it was made with, made on first use by get_osm
+        self.osm = None
+        self.osm_settings = None
+        self.osm_lock = threading.Lock()
 
     def __enter__(self):
         return self
 
-    def get_scats_volume(self, scats_number, location):
-        """ Gets the volume for a location over the entire time period
+    def get_sources(self):
+        """ Lists the files the dataset is built from
+
+        Returns:
+            list<String>: the monthly workbooks and the csv export
+        """
+        return [self.CSV_FILE] + sorted(glob.glob(self.DATA_SOURCES))
+
+    def build_cache(self):
+        """ Rebuilds the columnar cache, preferring the source spreadsheets over the csv export """
+        sources = self.get_sources()
+        workbooks = sources[1:]
+        if workbooks:
+            store.ingest_workbooks(workbooks, self.CACHE_DIRECTORY, sources)
+        else:
+            store.build_store(self.CSV_FILE, self.CACHE_DIRECTORY, sources)
+
+    def open_cache(self):
+        """ Reads the cache manifest and prepares the (not yet loaded) partitions """
+        manifest = store.read_manifest(self.CACHE_DIRECTORY)
+        self.partitions = [store.Partition(self.CACHE_DIRECTORY, key, partition["first_date"],
+                                           partition["last_date"], partition["rows"])
+                           for key, partition in sorted(manifest["partitions"].items())]
+        self.build_index(manifest["approaches"])
+        self.version = manifest["version"]
+        self.site_versions = manifest["site_versions"]
+
+        # Columns of the whole dataset, read through the partitions when first needed
+        self.columns = {}
+        # The distances between every pair of locations, computed when first needed
+        self.distances = None
+
+    def get_data_version(self, scats_number=None):
+        """ Gets an identifier that changes whenever the data changes, for keying anything derived from it
+
+        Parameters:
+            scats_number (int): the scats site identifier (None for the whole dataset)
+
+        Returns:
+            String: the version of the data for the site (or dataset)
+        """
+        if scats_number is None:
+            return self.version
+
+        return self.site_versions.get(str(int(scats_number)), "")
+
+    def append(self, columns):
+        """ Adds new days of data for any number of sites
+
+        Only the months the new rows fall in are rewritten, and only the data versions of the sites that received
+        rows change, so artifacts derived from other sites stay valid. Rows for a day that is already stored
+        replace it.
+
+        Parameters:
+            columns (dict): the arrays for each of the store columns (see data.store.read_csv_columns)
+
+        Returns:
+            list<int>: the sites whose data changed
+        """
+        with self.columns_lock:
+            sites = store.append_to_store(self.CACHE_DIRECTORY, columns)
+            self.open_cache()
+
+        with self.database_lock:
+            if self.database is not None:
+                self.database.ingest(columns, replace=False)
+                self.database.set_metadata("version", self.version)
+
+        return sites
+
+    def get_column(self, name):
+        """ Gets a column of the whole dataset
+
+        Parameters:
+            name (String): one of the store columns
+
+        Returns:
+            array: the column, memory-mapped from the only partition or read through the memory maps of every
+                partition (see data.store.PartitionedColumn), so the whole history is never copied into memory
+        """
+        with self.columns_lock:
+            if name not in self.columns:
+                parts = [partition.get_column(name) for partition in self.partitions]
+                if len(parts) == 1:
+                    self.columns[name] = parts[0]
+                else:
+                    self.columns[name] = store.PartitionedColumn(parts) if parts else np.empty((0,))
+
+        return self.columns[name]
+
+    @property
+    def sites(self):
+        return self.get_column("sites")
+
+    @property
+    def locations(self):
+        return self.get_column("locations")
+
+    @property
+    def names(self):
+        return self.get_column("names")
+
+    @property
+    def latitudes(self):
+        return self.get_column("latitudes")
+
+    @property
+    def longitudes(self):
+        return self.get_column("longitudes")
+
+    @property
+    def dates(self):
+        return self.get_column("dates")
+
+    @property
+    def volumes(self):
+        return self.get_column("volumes")
+
+    def get_partitions(self, start_date=None, end_date=None):
+        """ Gets the partitions that hold data for a date range
+
+        Parameters:
+            start_date (datetime64/String): the first day of the range (None for no lower bound)
+            end_date (datetime64/String): the last day of the range (None for no upper bound)
+
+        Returns:
+            list<Partition>: the partitions, in date order
+        """
+        start_date, end_date = to_day(start_date), to_day(end_date)
+
+        return [partition for partition in self.partitions if partition.overlaps(start_date, end_date)]
+
+    def get_database(self):
+        """ Opens the SQLite database, reloading it if it was built from a different version of the data
+
+        Returns:
+            ScatsDatabase: the database
+        """
+        with self.database_lock:
+            if self.database is None:
+                database = ScatsDatabase(self.DATABASE_FILE)
+                if database.get_metadata("version") != self.version:
+                    # One month at a time, so the whole dataset is never held in memory
+                    for i, partition in enumerate(self.partitions):
+                        database.ingest({name: partition.get_column(name) for name in store.COLUMNS}, replace=i == 0)
+                    database.set_metadata("version", self.version)
+                self.database = database
+
+        return self.database
+
+    def build_index(self, approaches):
+        """ Builds the lookup tables used by the point queries
+
+        Parameters:
+            approaches (list): [site, location, name, latitude, longitude] for every approach in the dataset
+        """
+        # (site, location) -> location name
+        self.location_names = {}
+        # location name -> location id (the first location with that name)
+        self.location_ids = {}
+        # site -> location ids in ascending order
+        self.approaches = {}
+        # (site, location) -> (latitude, longitude)
+        self.positions = {}
+        # Every day covered by the dataset, in order
+        if self.partitions:
+            self.days = np.arange(self.partitions[0].first_date, self.partitions[-1].last_date + 1)
+        else:
+            self.days = np.empty((0,), dtype="datetime64[D]")
+
+        for scats_number, location, name, latitude, longitude in approaches:
+            key = (scats_number, location)
+
+            self.location_names[key] = name
+            self.location_ids.setdefault(name, location)
+            self.approaches.setdefault(scats_number, []).append(location)
+            self.positions[key] = (latitude, longitude)
+
+        # (site, location) -> the row/column of the location in the distance matrix
+        self.junction_index = {junction: i for i, junction in enumerate(self.get_junctions())}
+
+    def get_scats_volume(self, scats_number, location, flat=False, start_date=None, end_date=None):
+        """ Gets the volume for a location over the entire time period, or a range of days
+
+        When the range falls within one month the result is a read-only view into the volume cache, so it must be
+        copied before being modified.
 
         Parameters:
             scats_number (int): the scats site identifier
             location (int): the VicRoads internal id/direction for the location
+            flat (bool): return the volumes as a single 1-D series rather than one row per day
+            start_date (datetime64/String): the first day to include, e.g. "2006-10-03" (None for the first day)
+            end_date (datetime64/String): the last day to include (None for the last day)
+
+        Returns:
+            array: the (days x 96) volumes, or (days * 96) volumes if flat
+        """
+        if self.USE_DATABASE:
+            _, volume_data = self.get_database().get_scats_volume(scats_number, location, start_date, end_date)
+        else:
+            volume_data = self.read_partitions("volumes", scats_number, location, start_date, end_date)
+
+        if flat:
+            volume_data = volume_data.reshape(-1)
+        volume_data.flags.writeable = False
+
+        return volume_data
+
+    def get_scats_dates(self, scats_number, location, start_date=None, end_date=None):
+        """ Gets the days a location has volumes for, matching the rows of get_scats_volume
+
+        Parameters:
+            scats_number (int): the scats site identifier
+            location (int): the VicRoads internal id/direction for the location
+            start_date (datetime64/String): the first day to include (None for the first day)
+            end_date (datetime64/String): the last day to include (None for the last day)
+
+        Returns:
+            array: the dates
+        """
+        if self.USE_DATABASE:
+            dates, _ = self.get_database().get_scats_volume(scats_number, location, start_date, end_date)
+            return dates
+
+        return self.read_partitions("dates", scats_number, location, start_date, end_date)
+
+    def read_partitions(self, name, scats_number, location, start_date=None, end_date=None):
+        """ Reads a column for a location from only the partitions covering a date range
+
+        Parameters:
+            name (String): the column to read
+            scats_number (int): the scats site identifier
+            location (int): the VicRoads internal id/direction for the location
+            start_date (datetime64/String): the first day to include (None for no lower bound)
+            end_date (datetime64/String): the last day to include (None for no upper bound)
+
+        Returns:
+            array: the column values, a view if they all come from one partition
+        """
+        start_date, end_date = to_day(start_date), to_day(end_date)
+
+        parts = []
+        for partition in self.get_partitions(start_date, end_date):
+            start, stop = partition.get_rows(scats_number, location, start_date, end_date)
+            if stop > start:
+                parts.append(partition.get_column(name)[start:stop])
+
+        if len(parts) == 1:
+            return parts[0]
+        if not parts:
+            empty = self.partitions[0].get_column(name)[:0] if self.partitions else np.empty((0,))
+            return empty.reshape((0,) + empty.shape[1:])
+
+        return np.concatenate(parts)
+
+    def get_scats_volumes(self, junctions=None, flat=False, fill_value=0, start_date=None, end_date=None,
+                          dtype=np.int32):
+        """ Gets the volumes for several locations at once, aligned by date
+
+        Parameters:
+            junctions (list<tuple>): the (scats_number, location) pairs, each given once (None for every location,
+                in the order of get_junctions)
+            flat (bool): return each location's volumes as a single 1-D series
+            fill_value (int): the volume used for days a location has no data for (e.g. NaN with a float dtype)
+            start_date (datetime64/String): the first day to include (None for the first day)
+            end_date (datetime64/String): the last day to include (None for the last day)
+            dtype (type): the data type of the volumes
+
+        Returns:
+            array: the (junctions x days x 96) volumes, where the days are get_days(start_date, end_date),
+                or (junctions x days * 96) if flat
+        """
+        if junctions is None:
+            junctions = self.get_junctions()
+        days = self.get_days(start_date, end_date)
+        volume_data = np.full((len(junctions), len(days), 96), fill_value, dtype=dtype)
+
+        if self.USE_DATABASE:
+            for i, junction in enumerate(junctions):
+                scats_number, location = junction
+                dates = self.get_scats_dates(scats_number, location, start_date, end_date)
+                volume_data[i, np.searchsorted(days, dates)] = self.get_scats_volume(scats_number, location,
+                                                                                     start_date=start_date,
+                                                                                     end_date=end_date)
+        elif len(junctions) and len(days):
+            keys = np.array([int(scats_number) * 1000 + int(location) for scats_number, location in junctions],
+                            dtype=np.int64)
+            order = np.argsort(keys)
+            sorted_keys = keys[order]
+
+            # Scatter every row of each month into the matrix at once, rather than searching for each location
+            for partition in self.get_partitions(days[0], days[-1]):
+                row_keys = partition.get_column("sites").astype(np.int64) * 1000 + partition.get_column("locations")
+                positions = np.minimum(np.searchsorted(sorted_keys, row_keys), len(keys) - 1)
+                row_days = (partition.get_column("dates") - days[0]).astype(np.int64)
+
+                rows = np.flatnonzero((sorted_keys[positions] == row_keys) & (row_days >= 0) & (row_days < len(days)))
+                volume_data[order[positions[rows]], row_days[rows]] = partition.get_column("volumes")[rows]
+
+        if flat:
+            volume_data = volume_data.reshape(len(junctions), -1)
+
+        return volume_data
+
+    def get_days(self, start_date=None, end_date=None):
+        """ Gets the days covered by the dataset
+
+        Parameters:
+            start_date (datetime64/String): the first day to include (None for the first day)
+            end_date (datetime64/String): the last day to include (None for the last day)
+
+        Returns:
+            array: the days, in order
         """
-        raw_data = self.data.loc[(self.data[0] == scats_number) & (self.data[7] == location)]
+        start_date, end_date = to_day(start_date), to_day(end_date)
+        first = 0 if start_date is None else np.searchsorted(self.days, start_date, side="left")
+        last = len(self.days) if end_date is None else np.searchsorted(self.days, end_date, side="right")
 
-        volume_data = []
-        for i in raw_data.index:
-            for n in range(10, 106):
-                volume_data.append(int(raw_data[n].loc[i]))
+        return self.days[first:last]
 
-        return np.array(volume_data)
+    def get_junctions(self):
+        """ Lists every location in the dataset
+
+        Returns:
+            list<tuple>: the (scats_number, location) pairs, ordered by site then location
+        """
+        return [(scats_number, location) for scats_number in sorted(self.approaches)
+                for location in self.approaches[scats_number]]
 
     def get_all_scats_numbers(self):
         """ Retrieves all the scats numbers """
-        return self.data[0].unique()
+        return np.array(list(self.approaches), dtype=np.int32)
 
     def count(self):
         """ Counts the number of rows in the database """
-        return len(self.data.index)
+        return sum(partition.rows for partition in self.partitions)
 
     def get_location_name(self, scats_number, location):
         """ Gets the name of the location given it's VicRoads internal identifier
@@ -127,9 +495,7 @@ class ScatsData(object):
         Returns:
             String: the name of the location
         """
-        raw_data = self.data.loc[(self.data[0] == scats_number) & (self.data[7] == location)]
-
-        return raw_data.iloc[0][1]
+        return self.location_names[(scats_number, location)]
 
     def get_location_id(self, location_name):
         """ Gets the VicRoads id of the location given it's name
@@ -140,9 +506,7 @@ class ScatsData(object):
         Returns:
             int: the VicRoads internal id/direction for the location
         """
-        raw_data = self.data.loc[self.data[1] == location_name]
-
-        return raw_data.iloc[0][7]
+        return self.location_ids[location_name]
 
     def get_scats_approaches(self, scats_number):
         """ Gets all the locations a vehicle can approach from given a scats site
@@ -153,9 +517,7 @@ class ScatsData(object):
         Returns:
             array: a list of all the location ids for a scats site
         """
-        raw_data = self.data.loc[self.data[0] == scats_number]
-
-        return [int(location) for location in raw_data[7].unique()]
+        return list(self.approaches.get(scats_number, []))
 
     def get_positional_data(self, scats_number, location):
         """ Gets the longitude and latitude values for a location
@@ -168,9 +530,52 @@ class ScatsData(object):
             float: geographic coordinate specifying the north–south position - latitude
             float: geographic coordinate specifying the east–west position - longitude
         """
-        raw_data = self.data.loc[(self.data[0] == scats_number) & (self.data[7] == location)]
+        return self.positions[(scats_number, location)]
+
+    def get_distance_matrix(self):
+        """ Gets the distance between every pair of locations, computed once per version of the data
+
+        Returns:
+            array: the read-only (locations x locations) distances in km, memory-mapped from the cache, where the
+                rows and columns are in the order of get_junctions (see junction_index)
+        """
+        with self.distances_lock:
+            if self.distances is None:
+                name = "distances-{0}".format(self.version[:16])
+                filepath = os.path.join(self.CACHE_DIRECTORY, name + ".npy")
+
+                if not os.path.exists(filepath):
+                    positions = np.array([self.positions[junction] for junction in self.get_junctions()],
+                                         dtype=np.float64).reshape(-1, 2)
+                    distances = haversine(positions[:, None, 0], positions[:, None, 1],
+                                          positions[None, :, 0], positions[None, :, 1])
+                    store.save_array(self.CACHE_DIRECTORY, name, distances)
 
-        return raw_data.iloc[0][3], raw_data.iloc[0][4]
+                    # Remove the matrices of older versions of the data
+                    for old_filepath in glob.glob(os.path.join(self.CACHE_DIRECTORY, "distances-*.npy")):
+                        if old_filepath != filepath:
+                            os.remove(old_filepath)
+
+                self.distances = np.load(filepath, mmap_mode="r")
+
+        return self.distances
+
+    def get_distances(self, edges):
+        """ Gets the distances for many sections of road at once
+
+        Parameters:
+            edges (array): (edges x 4) start site, start location, end site and end location of each road,
+                e.g. from Location.get_edge_array
+
+        Returns:
+            array: the distance of each road in km, in the same order as the edges
+        """
+        edges = np.asarray(edges, dtype=np.int64).reshape(-1, 4)
+        origins = [self.junction_index[(scats_number, location)] for scats_number, location in edges[:, :2].tolist()]
+        destinations = [self.junction_index[(scats_number, location)] for scats_number, location in
+                        edges[:, 2:].tolist()]
+
+        return self.get_distance_matrix()[origins, destinations]
 
     def get_relational_positional_data(self, scats_number, location):
 
@@ -211,18 +616,91 @@ class ScatsData(object):
         Returns:
             int: the speed limit of the road (in km/h)
         """
-        speed_limit = self.DEFAULT_SPEED_LIMIT
+        key = (int(begin_scats_number), int(begin_location), int(end_scats_number), int(end_location))
 
-        start_road = "{0}-{1}".format(begin_scats_number, begin_location)
-        end_road = "{0}-{1}".format(end_scats_number, end_location)
+        return self.get_speed_limit_table().get(key, self.DEFAULT_SPEED_LIMIT)
 
-        try:
-            raw_data = self.roads.loc[(self.roads[1] == start_road) & (self.roads[2] == end_road)]
-            speed_limit = raw_data.iloc[0][3]
-        except KeyError:
-            pass
+    def get_speed_limit_table(self):
+        """ Compiles the NodeConnections sheet of the Mapping Data file into a lookup table (the first time only)
 
-        return speed_limit
+        Returns:
+            dict: (start site, start location, end site, end location) -> speed limit (in km/h)
+        """
+        with self.speed_limits_lock:
+            if self.speed_limits is None:
+                speed_limits = {}
+                if os.path.exists(self.MAPPING_DATA):
+                    roads = pd.read_excel(self.MAPPING_DATA, sheet_name='NodeConnections')
+                    # Columns: id, start road ("site-location"), end road, speed limit, name
+                    for start_road, end_road, speed_limit in zip(roads.iloc[:, 1], roads.iloc[:, 2], roads.iloc[:, 3]):
+                        start_scats_number, start_location = (int(value) for value in str(start_road).split("-"))
+                        end_scats_number, end_location = (int(value) for value in str(end_road).split("-"))
+                        key = (start_scats_number, start_location, end_scats_number, end_location)
+                        speed_limits[key] = int(speed_limit)
+                self.speed_limits = speed_limits
+
+        return self.speed_limits
+
+    def get_speed_limits(self, edges):
+        """ Gets the speed limits for many sections of road at once
+
+        The limits of an edge list are compiled into a dense array aligned to the edge ids the first time the list is
+        seen, so asking again for the same routing graph is only an array lookup.
+
+        Parameters:
+            edges (array): (edges x 4) start site, start location, end site and end location of each road,
+                e.g. from Location.get_edge_array
+
+        Returns:
+            array: the read-only speed limit of each road (in km/h), in the same order as the edges
+        """
+        edges = np.ascontiguousarray(edges, dtype=np.int64).reshape(-1, 4)
+        key = (self.get_osm_settings() if self.USE_SPEED_LIMITS_FROM_OSM else None, edges.tobytes())
+
+        with self.speed_limits_lock:
+            speed_limits = self.speed_limit_arrays.get(key)
+            if speed_limits is not None:
+                self.speed_limit_arrays.move_to_end(key)
+                return speed_limits
+
+        if self.USE_SPEED_LIMITS_FROM_OSM:
+            roads = [self.get_osm_road(*edge) for edge in edges.tolist()]
+            speed_limits = np.array(self.get_osm().get_speed_limits(roads, self.DEFAULT_SPEED_LIMIT), dtype=np.int64)
+        else:
+            table = self.get_speed_limit_table()
+            speed_limits = np.array([table.get(tuple(edge), self.DEFAULT_SPEED_LIMIT) for edge in edges.tolist()],
+                                    dtype=np.int64)
+        speed_limits.flags.writeable = False
+
+        with self.speed_limits_lock:
+            self.speed_limit_arrays[key] = speed_limits
+            while len(self.speed_limit_arrays) > self.SPEED_LIMIT_ARRAYS:
+                self.speed_limit_arrays.popitem(last=False)
+
+        return speed_limits
+
+    def get_osm_settings(self):
+        """ Gets the settings the OpenStreetMap speed limits are looked up with """
+        return (self.OSM_CACHE_DIRECTORY, self.OSM_ENDPOINT, self.OSM_OFFLINE, self.OSM_CONCURRENCY,
+                self.OSM_REQUESTS_PER_SECOND)
+
+    def get_osm(self):
+        """ Gets the OpenStreetMap speed limit lookup, made again whenever the OSM settings have changed
+
+        Returns:
+            OsmSpeedLimits: the lookup for the current settings
+        """
+        settings = self.get_osm_settings()
+        with self.osm_lock:
+            if self.osm is None or self.osm_settings != settings:
+                if self.osm is not None:
+                    self.osm.close()
+                cache_directory, endpoint, offline, concurrency, rate = settings
+                self.osm = OsmSpeedLimits(cache_directory, endpoint, offline=offline, concurrency=concurrency,
+                                          rate=rate)
+                self.osm_settings = settings
+
+            return self.osm
 
     def get_speed_limit_from_osm(self, begin_scats_number, begin_location, end_scats_number, end_location):
         """ Gets the speed limit for a section of road from OpenStreetMaps
@@ -236,10 +714,24 @@ class ScatsData(object):
         Returns:
             int: the speed limit of the road (in km/h)
         """
-        speed_limit = self.DEFAULT_SPEED_LIMIT
+        road_name, name, bbox = self.get_osm_road(begin_scats_number, begin_location, end_scats_number, end_location)
 
-        api = op.API(endpoint="https://lz4.overpass-api.de/api/interpreter", timeout=60)
+        return self.get_osm().get_speed_limit(road_name, name, bbox, self.DEFAULT_SPEED_LIMIT)
 
+    def get_osm_road(self, begin_scats_number, begin_location, end_scats_number, end_location):
+        """ Describes a section of road the way it is searched for in OpenStreetMaps
+
+        Parameters:
+            begin_scats_number (int): the scats site identifier for the start of the road
+            begin_location (int): the VicRoads internal id/direction for the start of the road
+            end_scats_number (int): the scats site identifier for the end of the road
+            end_location (int): the VicRoads internal id/direction for the end of the road
+
+        Returns:
+            String: the name of the road (without the road type)
+            String: the full name of the road
+            tuple: the south, west, north and east edges of the section of road
+        """
         s_latitude, s_longitude = self.get_positional_data(begin_scats_number, begin_location)
         e_latitude, e_longitude = self.get_positional_data(end_scats_number, end_location)
 
@@ -249,52 +741,98 @@ class ScatsData(object):
         road_type = self.CONVENTIONS[location[1].split(" ")[0]]
         name = "{0} {1}".format(road_name, road_type)
 
-        way = 'way["name"~"{0}"]({1},{2},{3},{4});(._;>;)'
-        if s_latitude < e_latitude:
-            if s_longitude < e_longitude:
-                way = way.format(road_name, s_latitude, s_longitude, e_latitude, e_longitude)
-            else:
-                way = way.format(road_name, s_latitude, e_longitude, e_latitude, s_longitude)
+        bbox = bounding_box(s_latitude, s_longitude, e_latitude, e_longitude)
+
+        return road_name, name, bbox
+
+    def prefetch_osm_speed_limits(self, margin=0.01):
+        """ Downloads the OpenStreetMap roads for the whole network in one query
+
+        After this, get_speed_limit_from_osm matches roads against the downloaded ways instead of sending a
+        query for every section of road.
+
+        Parameters:
+            margin (float): the number of degrees added around the SCATS sites
+        """
+        latitudes = [latitude for latitude, _ in self.positions.values()]
+        longitudes = [longitude for _, longitude in self.positions.values()]
+        bbox = (min(latitudes) - margin, min(longitudes) - margin, max(latitudes) + margin, max(longitudes) + margin)
+
+        self.get_osm().prefetch(bbox)
+
+    def get_training_data(self, dtype=np.float32, shuffle=True, save_location=None, chunk_size=1 << 20):
+        """ Builds the features and labels for training the generalised model
+
+        Each sample is one 15 minute interval of one day at one location. The features are the relative position,
+        the cyclic direction, the cyclic time of day and the cyclic day of the week, and the label is the scaled
+        volume. Shuffling is done by generating the samples in a permuted order, so rows are never moved.
+
+        Parameters:
+            dtype (type): the data type of the output arrays
+            shuffle (bool): whether to shuffle the samples
+            save_location (String): if given, the arrays are written to memory-mapped x_train.npy and y_train.npy
+                files in this directory instead of being held in memory
+            chunk_size (int): the number of samples generated at a time, which bounds the temporary memory used
+
+        Returns:
+            array: the (samples x 8) features
+            array: the (samples x 1) labels
+        """
+        samples = self.count() * 96
+
+        if save_location is None:
+            x_train = np.empty((samples, 8), dtype=dtype)
+            y_train = np.empty((samples, 1), dtype=dtype)
         else:
-            if s_longitude < e_longitude:
-                way = way.format(road_name, e_latitude, s_longitude, s_latitude, e_longitude)
-            else:
-                way = way.format(road_name, e_latitude, e_longitude, s_latitude, s_longitude)
-
-        data = api.get(way, verbosity='geom')
-        for feature in data["features"]:
-            properties = feature["properties"]
-
-            name_fields = ["name", "alt-name"]
-            for name_field in name_fields:
-                if name_field in properties.keys():
-                    if properties[name_field] == name:
-                        if "maxspeed" in properties.keys():
-                            speed_limit = int(properties["maxspeed"])
+            if not os.path.exists(save_location):
+                os.makedirs(save_location)
+            x_train = np.lib.format.open_memmap(os.path.join(save_location, "x_train.npy"), mode="w+",
+                                                dtype=dtype, shape=(samples, 8))
+            y_train = np.lib.format.open_memmap(os.path.join(save_location, "y_train.npy"), mode="w+",
+                                                dtype=dtype, shape=(samples, 1))
 
-        return speed_limit
+        order = np.random.permutation(samples) if shuffle else None
+        for begin in range(0, samples, chunk_size):
+            end = min(begin + chunk_size, samples)
+            sample = order[begin:end] if shuffle else np.arange(begin, end)
+            self.fill_samples(sample, x_train[begin:end], y_train[begin:end])
+
+        return x_train, y_train
+
+    def fill_samples(self, samples, x_out, y_out):
+        """ Writes the features and labels for a set of samples
+
+        The features are computed from only the rows the samples come from, so the memory used depends on the number
+        of samples rather than the size of the dataset.
+
+        Parameters:
+            samples (array): the sample indices (row * 96 + time interval)
+            x_out (array): the (samples x 8) array the features are written to
+            y_out (array): the (samples x 1) array the labels are written to
+        """
+        rows, intervals = np.divmod(samples, 96)
+
+        x_out[:, [0, 1, 2, 3, 6, 7]] = self.get_row_features(rows)
+        x_out[:, 4] = utility.SIN_TIMES[intervals]
+        x_out[:, 5] = utility.COS_TIMES[intervals]
+        y_out[:, 0] = self.volumes[rows, intervals] / self.MAX_TRAFFIC
+
+    def get_row_features(self, rows=slice(None)):
+        """ Computes the features shared by every interval of a row (one day at one location)
+
+        Parameters:
+            rows (array): the rows to compute the features of (defaults to every row)
+
+        Returns:
+            array: the (rows x 6) latitude, longitude, direction sine/cosine and day sine/cosine features
+        """
+        latitudes, longitudes = self.latitudes[rows], self.longitudes[rows]
+        features = np.zeros((len(latitudes), 6))
+
+        features[:, 0], features[:, 1] = utility.convert_absolute_coordinates_to_relative(latitudes, longitudes)
 
-    def get_training_data(self):
-        train_data = np.zeros((len(self.data)*96, 9))
-        count = 0
-        rows = self.data.to_numpy()
-        for i in range(len(rows)):
-            row = rows[i]
-            lat, long = utility.convert_absolute_coordinates_to_relative(row[3], row[4])
-            direction = int(row[7])
-            volume = row[10:106]
-            valid_junction = False
-            if 0 < direction < 9:
-                valid_junction = True
-            for n in range(96):
-                train_data[count][0] = lat
-                train_data[count][1] = long
-                if valid_junction:
-                    train_data[count][2], train_data[count][3] = utility.convert_direction_to_cyclic(direction)
-                train_data[count][4], train_data[count][5] = utility.convert_time_interval_to_cyclic(n)
-                train_data[count][6], train_data[count][7] = utility.convert_date_to_cyclic_day(row[9])
-                train_data[count][8] = volume[n] / self.MAX_TRAFFIC
-                count += 1
-        np.random.shuffle(train_data)
-        return train_data[0:, 0:8], train_data[0:, 8:]
+        # Only the eight compass directions have a cyclic encoding, anything else is left as zero
+        features[:, 2], features[:, 3] = utility.convert_directions_to_cyclic(self.locations[rows])
+        features[:, 4], features[:, 5] = utility.convert_dates_to_cyclic_days(self.dates[rows])
 
+        return features
@@ -0,0 +1,188 @@
+import copy
+import math
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from keras.utils import Sequence
+
+
+def random_affine_permutation(count, random_state):
+    """ Picks a random permutation of range(count) of the form k -> (a * k + c) mod count
+
+    Unlike np.random.permutation this needs no memory, so it can shuffle datasets of any size.
+
+    Parameters:
+        count (int): the number of items to permute
+        random_state (RandomState): the source of randomness
+
+    Returns:
+        int: the multiplier a (coprime with count)
+        int: the offset c
+    """
+    if count < 2:
+        return 1, 0
+
+    while True:
+        multiplier = int(random_state.randint(1, count))
+        if math.gcd(multiplier, count) == 1:
+            return multiplier, int(random_state.randint(0, count))
+
+
+def apply_permutation(permutation, positions, count):
+    """ Maps positions through a permutation from random_affine_permutation
+
+    Parameters:
+        permutation (tuple): the multiplier and offset
+        positions (array): the positions to map
+        count (int): the number of items permuted
+
+    Returns:
+        array: the permuted positions
+    """
+    multiplier, offset = permutation
+
+    return (multiplier * positions + offset) % count
+
+
+class TrainingSequence(Sequence):
+    """ Streams shuffled mini-batches of the generalised training set
+
+    Batches are generated on demand from the (memory-mapped) columns of the dataset, encoding only the rows each
+    batch samples, so the memory used depends on the batch size rather than the size of the dataset. The next few
+    batches are prepared on a background thread while the current one is being trained on, until close is called.
+    """
+
+    def __init__(self, scats_data, batch_size, shuffle=True, expand_dims=False, dtype=np.float32, prefetch=4,
+                 seed=None):
+        """
+        Parameters:
+            scats_data (ScatsData): the dataset to generate samples from
+            batch_size (int): the number of samples in each batch
+            shuffle (bool): whether to shuffle the samples (reshuffled every epoch)
+            expand_dims (bool): shape the features as (batch, 8, 1) for the recurrent models
+            dtype (type): the data type of the batches
+            prefetch (int): the number of batches to prepare ahead of time (0 disables the background thread)
+            seed (int): the seed for the shuffling
+        """
+        super(TrainingSequence, self).__init__()
+        self.scats_data = scats_data
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.expand_dims = expand_dims
+        self.dtype = dtype
+        self.prefetch = prefetch
+        self.random_state = np.random.RandomState(seed)
+
+        self.samples = scats_data.count() * 96
+        # The range of positions (in split order) covered by this sequence
+        self.start, self.stop = 0, self.samples
+        # Gives every sample a fixed position so that splits of the sequence never overlap
+        self.split_order = random_affine_permutation(self.samples, self.random_state) if shuffle else (1, 0)
+        self.epoch_order = (1, 0)
+
+        self.reset_prefetch()
+        self.on_epoch_end()
+
+    def __len__(self):
+        return math.ceil(self.sample_count() / self.batch_size)
+
+    @property
+    def shape(self):
+        """ The shape of the full feature matrix this sequence generates """
+        return self.sample_count(), 8
+
+    def sample_count(self):
+        """ Counts the number of samples in the sequence """
+        return self.stop - self.start
+
+    def split(self, fraction):
+        """ Splits the sequence into two sequences with no samples in common
+
+        Parameters:
+            fraction (float): the fraction of the samples that go into the first sequence
+
+        Returns:
+            TrainingSequence: the first part
+            TrainingSequence: the remaining part
+        """
+        middle = self.start + int(self.sample_count() * fraction)
+
+        first, second = copy.copy(self), copy.copy(self)
+        first.stop = middle
+        second.start = middle
+        for sequence in first, second:
+            sequence.random_state = np.random.RandomState(self.random_state.randint(2 ** 31))
+            sequence.reset_prefetch()
+            sequence.on_epoch_end()
+
+        return first, second
+
+    def reset_prefetch(self):
+        """ Discards any prepared batches """
+        self.lock = threading.Lock()
+        self.executor = None
+        self.pending = {}
+
+    def close(self):
+        """ Discards any prepared batches and stops the background thread, it is started again if more are asked for """
+        with self.lock:
+            for future in self.pending.values():
+                future.cancel()
+            self.pending = {}
+
+            if self.executor is not None:
+                self.executor.shutdown(wait=True)
+                self.executor = None
+
+    def on_epoch_end(self):
+        """ Reshuffles the samples for the next epoch """
+        with self.lock:
+            for future in self.pending.values():
+                future.cancel()
+            self.pending = {}
+
+            if self.shuffle:
+                self.epoch_order = random_affine_permutation(self.sample_count(), self.random_state)
+
+    def __getitem__(self, index):
+        with self.lock:
+            future = self.pending.pop(index, None)
+            epoch_order = self.epoch_order
+
+            if self.prefetch > 0:
+                if self.executor is None:
+                    self.executor = ThreadPoolExecutor(max_workers=1)
+                for upcoming in range(index + 1, min(index + 1 + self.prefetch, len(self))):
+                    if upcoming not in self.pending:
+                        self.pending[upcoming] = self.executor.submit(self.get_batch, upcoming, epoch_order)
+
+        if future is not None:
+            return future.result()
+
+        return self.get_batch(index, epoch_order)
+
+    def get_batch(self, index, epoch_order):
+        """ Generates a batch of samples
+
+        Parameters:
+            index (int): the index of the batch
+            epoch_order (tuple): the permutation used for the current epoch
+
+        Returns:
+            array: the features
+            array: the labels
+        """
+        count = self.sample_count()
+        positions = np.arange(index * self.batch_size, min((index + 1) * self.batch_size, count), dtype=np.int64)
+        positions = apply_permutation(epoch_order, positions, count) + self.start
+        samples = apply_permutation(self.split_order, positions, self.samples)
+
+        x = np.empty((len(samples), 8), dtype=self.dtype)
+        y = np.empty((len(samples), 1), dtype=self.dtype)
+        self.scats_data.fill_samples(samples, x, y)
+
+        if self.expand_dims:
+            x = np.reshape(x, (x.shape[0], x.shape[1], 1))
+
+        return x, y
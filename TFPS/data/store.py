@@ -0,0 +1,682 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+import xlrd
+
+# The columns kept from the VicRoads export, stored as one .npy file each
+COLUMNS = ["sites", "locations", "names", "latitudes", "longitudes", "dates", "volumes"]
+MANIFEST_FILE = "manifest.json"
+# Bumped whenever the layout of the store changes, so stores written by older code are rebuilt
+STORE_FORMAT = 2
+# The dataset is split into one partition (sub-directory) per month
+PARTITION_FORMAT = "datetime64[M]"
+# Rows added with append_to_store are also kept here, so they survive the store being rebuilt from its sources
+APPENDED_DIRECTORY = "appended"
+
+# Excel (1900 date system) serial day zero
+EXCEL_EPOCH = np.datetime64("1899-12-30", "D")
+
+
+def excel_serial_to_date(serials):
+    """ Converts an array of Excel serial dates into calendar days
+
+    Parameters:
+        serials (array): the Excel serial values (the fractional part holds the time of day)
+
+    Returns:
+        array: the dates as datetime64[D] values
+    """
+    days = np.floor(np.asarray(serials, dtype=np.float64)).astype(np.int64)
+
+    return EXCEL_EPOCH + days.astype("timedelta64[D]")
+
+
+def file_signature(filepath, content_hash=False):
+    """ Describes the state of a file so changes can be detected
+
+    Parameters:
+        filepath (String): the file to describe
+        content_hash (bool): whether to include a hash of the file contents
+
+    Returns:
+        dict: the modification time, size and (optionally) the sha1 of the file
+    """
+    stat = os.stat(filepath)
+    signature = {"mtime": stat.st_mtime, "size": stat.st_size}
+
+    if content_hash:
+        sha1 = hashlib.sha1()
+        with open(filepath, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                sha1.update(chunk)
+        signature["sha1"] = sha1.hexdigest()
+
+    return signature
+
+
+def read_manifest(directory):
+    """ Reads the manifest of a columnar store
+
+    Parameters:
+        directory (String): the store directory
+
+    Returns:
+        dict: the manifest, or None if the store has not been built
+    """
+    filepath = os.path.join(directory, MANIFEST_FILE)
+    if not os.path.exists(filepath):
+        return None
+
+    with open(filepath, "r") as f:
+        return json.load(f)
+
+
+def is_store_current(directory, sources, content_hash=False):
+    """ Checks whether a columnar store was built from the current version of its sources
+
+    Parameters:
+        directory (String): the store directory
+        sources (list<String>): the files the store is built from
+        content_hash (bool): compare file contents instead of modification times
+
+    Returns:
+        bool: True if the store exists and none of the sources have changed
+    """
+    manifest = read_manifest(directory)
+    if manifest is None or manifest.get("format") != STORE_FORMAT:
+        return False
+
+    for key in manifest.get("partitions", {}):
+        partition_directory = os.path.join(directory, key)
+        if any(not os.path.exists(os.path.join(partition_directory, column + ".npy")) for column in COLUMNS):
+            return False
+
+    recorded = manifest.get("sources", {})
+    for source in sources:
+        if not os.path.exists(source):
+            continue
+        if source not in recorded:
+            return False
+
+        signature = file_signature(source, content_hash)
+        if content_hash:
+            if recorded[source].get("sha1") != signature["sha1"]:
+                return False
+        elif recorded[source]["mtime"] != signature["mtime"] or recorded[source]["size"] != signature["size"]:
+            return False
+
+    return True
+
+
+def save_array(directory, name, array):
+    """ Writes an array to the store without exposing a partially written file
+
+    Parameters:
+        directory (String): the store directory
+        name (String): the column name
+        array (array): the values to store
+    """
+    filepath = os.path.join(directory, name + ".npy")
+    temp_filepath = "{0}.{1}.tmp".format(filepath, os.getpid())
+    with open(temp_filepath, "wb") as f:
+        np.save(f, np.ascontiguousarray(array))
+    os.replace(temp_filepath, filepath)
+
+
+def write_store(directory, columns, sources):
+    """ Writes the columns of one partition into the store, sorted by site, location and date
+
+    Parameters:
+        directory (String): the partition directory
+        columns (dict): the arrays for each of the COLUMNS
+        sources (list<String>): the files the columns were read from
+    """
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    order = np.lexsort((columns["dates"], columns["locations"], columns["sites"]))
+    for name in COLUMNS:
+        save_array(directory, name, columns[name][order])
+
+    manifest = {
+        "rows": int(len(order)),
+        "sources": {source: file_signature(source, True) for source in sources if os.path.exists(source)}
+    }
+    write_manifest(directory, manifest)
+
+
+def write_manifest(directory, manifest):
+    """ Replaces the manifest of a store
+
+    Parameters:
+        directory (String): the store directory
+        manifest (dict): the new manifest
+    """
+    temp_filepath = os.path.join(directory, MANIFEST_FILE + ".tmp")
+    with open(temp_filepath, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(temp_filepath, os.path.join(directory, MANIFEST_FILE))
+
+
+def select_rows(columns, rows):
+    """ Selects a subset of the rows of every column
+
+    Parameters:
+        columns (dict): the arrays for each of the COLUMNS
+        rows (array): the indices or mask of the rows to keep
+
+    Returns:
+        dict: the selected rows of each column
+    """
+    return {name: np.asarray(columns[name])[rows] for name in COLUMNS}
+
+
+def concatenate_columns(column_sets):
+    """ Joins several sets of columns into one
+
+    Parameters:
+        column_sets (list<dict>): the column sets
+
+    Returns:
+        dict: the concatenated arrays for each of the COLUMNS
+    """
+    return {name: np.concatenate([columns[name] for columns in column_sets]) for name in COLUMNS}
+
+
+def describe_approaches(columns):
+    """ Lists every (site, location) in a set of columns with the details used by the point lookups
+
+    Parameters:
+        columns (dict): the arrays for each of the COLUMNS
+
+    Returns:
+        list: [site, location, name, latitude, longitude] for each approach, ordered by site and location
+    """
+    keys = np.stack((columns["sites"], columns["locations"]), axis=1)
+    _, first_rows = np.unique(keys, axis=0, return_index=True)
+
+    return [[int(columns["sites"][i]), int(columns["locations"][i]), str(columns["names"][i]),
+             float(columns["latitudes"][i]), float(columns["longitudes"][i])] for i in first_rows]
+
+
+def write_partitioned_store(directory, columns, sources):
+    """ Writes the dataset into the store as one partition per month
+
+    The top level manifest lists the partitions and the approaches, so the store can be opened without loading
+    any of the partitions.
+
+    Parameters:
+        directory (String): the store directory
+        columns (dict): the arrays for each of the COLUMNS
+        sources (list<String>): the files the columns were read from
+    """
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    old_manifest = read_manifest(directory) or {}
+
+    months = np.asarray(columns["dates"]).astype(PARTITION_FORMAT)
+    partitions = {}
+    for month in np.unique(months):
+        key = str(month)
+        part = select_rows(columns, months == month)
+        write_store(os.path.join(directory, key), part, [])
+        partitions[key] = {
+            "rows": int(len(part["sites"])),
+            "first_date": str(part["dates"].min()),
+            "last_date": str(part["dates"].max())
+        }
+
+    signatures = {source: file_signature(source, True) for source in sources if os.path.exists(source)}
+    version = chain_version("", *(signature["sha1"] for signature in signatures.values()))
+    manifest = {
+        "format": STORE_FORMAT,
+        "rows": int(len(columns["sites"])),
+        "partitions": partitions,
+        "approaches": describe_approaches(columns),
+        "sources": signatures,
+        "version": version,
+        "site_versions": {str(site): version for site in np.unique(columns["sites"])}
+    }
+    write_manifest(directory, manifest)
+
+    # Remove the months that are no longer in the source data
+    for key in old_manifest.get("partitions", {}):
+        if key not in partitions:
+            shutil.rmtree(os.path.join(directory, key), ignore_errors=True)
+
+    # Put back the rows that were appended since the sources were last read. Rows the sources now hold themselves
+    # are dropped from the copies, so the newer source rows are kept and the copies stop growing.
+    appended_directory = os.path.join(directory, APPENDED_DIRECTORY)
+    if os.path.exists(appended_directory):
+        source_keys = np.unique(row_keys(columns))
+        for filename in sorted(os.listdir(appended_directory)):
+            filepath = os.path.join(appended_directory, filename)
+            with np.load(filepath) as batch:
+                batch = {name: batch[name] for name in COLUMNS}
+
+            pending = ~np.isin(row_keys(batch), source_keys)
+            if not pending.any():
+                os.remove(filepath)
+                continue
+            if not pending.all():
+                batch = select_rows(batch, pending)
+                np.savez(filepath, **batch)
+            append_to_store(directory, batch, journal=False)
+
+
+def chain_version(version, *changes):
+    """ Derives a new data version from the previous one and the changes made to the data
+
+    Parameters:
+        version (String): the previous version
+        changes (list<String>): hashes describing the changes
+
+    Returns:
+        String: the new version
+    """
+    sha1 = hashlib.sha1(version.encode("utf-8"))
+    for change in changes:
+        sha1.update(change.encode("utf-8"))
+
+    return sha1.hexdigest()
+
+
+def hash_columns(columns):
+    """ Hashes the contents of a set of columns
+
+    Parameters:
+        columns (dict): the arrays for each of the COLUMNS
+
+    Returns:
+        String: the sha1 of the data
+    """
+    sha1 = hashlib.sha1()
+    for name in COLUMNS:
+        sha1.update(np.ascontiguousarray(columns[name]).tobytes())
+
+    return sha1.hexdigest()
+
+
+def row_keys(columns):
+    """ Combines the site, location and date of each row into a single integer key
+
+    Parameters:
+        columns (dict): the arrays for each of the COLUMNS
+
+    Returns:
+        array: the int64 key for each row
+    """
+    sites = np.asarray(columns["sites"]).astype(np.int64)
+    locations = np.asarray(columns["locations"]).astype(np.int64)
+    days = np.asarray(columns["dates"]).astype("datetime64[D]").astype(np.int64)
+
+    return (sites * 1000 + locations) * 1000000 + days
+
+
+def append_to_store(directory, columns, journal=True):
+    """ Adds new rows to the store, rewriting only the partitions (months) they fall in
+
+    Rows for a site, location and date that is already stored replace the stored row. The data version of the
+    store, and of each site that received rows, changes so that anything derived from that data can tell it is
+    out of date.
+
+    Parameters:
+        directory (String): the store directory
+        columns (dict): the arrays for each of the COLUMNS
+        journal (bool): also keep a copy of the rows so they are restored when the store is rebuilt
+
+    Returns:
+        list<int>: the sites that received rows
+    """
+    columns = {name: np.asarray(columns[name]) for name in COLUMNS}
+    columns["dates"] = columns["dates"].astype("datetime64[D]")
+    if not len(columns["sites"]):
+        return []
+
+    manifest = read_manifest(directory)
+    batch_hash = hash_columns(columns)
+
+    if journal:
+        appended_directory = os.path.join(directory, APPENDED_DIRECTORY)
+        if not os.path.exists(appended_directory):
+            os.makedirs(appended_directory)
+        # Numbered after the last copy, as copies the sources have caught up with are removed
+        numbers = [int(filename.split("-")[0]) for filename in os.listdir(appended_directory)]
+        filename = "{0:06d}-{1}.npz".format(max(numbers, default=-1) + 1, batch_hash[:12])
+        np.savez(os.path.join(appended_directory, filename), **columns)
+
+    months = columns["dates"].astype(PARTITION_FORMAT)
+    for month in np.unique(months):
+        key = str(month)
+        partition_directory = os.path.join(directory, key)
+        part = select_rows(columns, months == month)
+
+        if key in manifest["partitions"]:
+            # Read the stored rows into memory, the files are about to be replaced
+            stored = {name: np.array(values) for name, values in load_store(partition_directory).items()}
+            kept = ~np.isin(row_keys(stored), row_keys(part))
+            part = concatenate_columns([select_rows(stored, kept), part])
+
+        write_store(partition_directory, part, [])
+        manifest["partitions"][key] = {
+            "rows": int(len(part["sites"])),
+            "first_date": str(part["dates"].min()),
+            "last_date": str(part["dates"].max())
+        }
+
+    approaches = {(approach[0], approach[1]): approach for approach in manifest["approaches"]}
+    for approach in describe_approaches(columns):
+        approaches.setdefault((approach[0], approach[1]), approach)
+    manifest["approaches"] = [approaches[key] for key in sorted(approaches)]
+    manifest["rows"] = sum(partition["rows"] for partition in manifest["partitions"].values())
+
+    sites = [int(site) for site in np.unique(columns["sites"])]
+    manifest["version"] = chain_version(manifest["version"], batch_hash)
+    for site in sites:
+        site_version = manifest["site_versions"].get(str(site), "")
+        manifest["site_versions"][str(site)] = chain_version(site_version, batch_hash)
+
+    write_manifest(directory, manifest)
+
+    return sites
+
+
+def read_csv_columns(csv_file):
+    """ Parses the VicRoads csv export into typed column arrays
+
+    Parameters:
+        csv_file (String): the csv file
+
+    Returns:
+        dict: the arrays for each of the COLUMNS
+    """
+    dataset = pd.read_csv(csv_file, encoding="latin-1", sep=",", header=None)
+
+    return {
+        "sites": dataset[0].to_numpy(dtype=np.int32),
+        "locations": dataset[7].to_numpy(dtype=np.int32),
+        "names": dataset[1].to_numpy(dtype=str),
+        "latitudes": dataset[3].to_numpy(dtype=np.float64),
+        "longitudes": dataset[4].to_numpy(dtype=np.float64),
+        "dates": excel_serial_to_date(dataset[9].to_numpy()),
+        "volumes": dataset.iloc[:, 10:106].to_numpy(dtype=np.int32)
+    }
+
+
+def read_workbook_columns(input_name, sheet_index=1, header_rows=2, chunk_size=4096):
+    """ Reads the VicRoads spreadsheet into typed column arrays, a chunk of rows at a time
+
+    Parameters:
+        input_name (String): the xls file
+        sheet_index (int): the sheet holding the data
+        header_rows (int): the number of rows before the data starts
+        chunk_size (int): the number of rows converted at a time
+
+    Returns:
+        dict: the arrays for each of the COLUMNS
+    """
+    workbook = xlrd.open_workbook(input_name, on_demand=True)
+    try:
+        sheet = workbook.sheet_by_index(sheet_index)
+        count = max(sheet.nrows - header_rows, 0)
+
+        columns = {
+            "sites": np.empty(count, dtype=np.int32),
+            "locations": np.empty(count, dtype=np.int32),
+            "names": [],
+            "latitudes": np.empty(count, dtype=np.float64),
+            "longitudes": np.empty(count, dtype=np.float64),
+            "dates": np.empty(count, dtype="datetime64[D]"),
+            "volumes": np.empty((count, 96), dtype=np.int32)
+        }
+
+        for begin in range(0, count, chunk_size):
+            end = min(begin + chunk_size, count)
+            rows = np.array([sheet.row_values(header_rows + n, 0, 106) for n in range(begin, end)], dtype=object)
+
+            # Site numbers are stored as zero padded text, e.g. "0970"
+            columns["sites"][begin:end] = rows[:, 0].astype(np.float64)
+            columns["locations"][begin:end] = rows[:, 7].astype(np.float64)
+            columns["names"].extend(str(name) for name in rows[:, 1])
+            columns["latitudes"][begin:end] = rows[:, 3].astype(np.float64)
+            columns["longitudes"][begin:end] = rows[:, 4].astype(np.float64)
+            columns["dates"][begin:end] = excel_serial_to_date(rows[:, 9].astype(np.float64))
+            columns["volumes"][begin:end] = rows[:, 10:106].astype(np.float64)
+    finally:
+        workbook.release_resources()
+
+    columns["names"] = np.array(columns["names"], dtype=str)
+
+    return columns
+
+
+def ingest_workbooks(input_names, directory, sources=None):
+    """ Builds the columnar store straight from the VicRoads spreadsheets, without going through a csv file
+
+    Parameters:
+        input_names (list<String>): the xls files (typically one per month)
+        directory (String): the store directory
+        sources (list<String>): the files to record in the manifest (defaults to the xls files)
+
+    Returns:
+        float: the number of rows ingested per second
+    """
+    start_time = time.perf_counter()
+    columns = concatenate_columns([read_workbook_columns(input_name) for input_name in input_names])
+    write_partitioned_store(directory, columns, sources or input_names)
+    elapsed = time.perf_counter() - start_time
+
+    rows = len(columns["sites"])
+    rate = rows / elapsed if elapsed > 0 else float("inf")
+    print("Ingested {0} rows from {1} workbook(s) in {2:.2f}s ({3:.0f} rows/s)".format(
+        rows, len(input_names), elapsed, rate))
+
+    return rate
+
+
+def build_store(csv_file, directory, sources=None):
+    """ Builds the columnar store from the csv export
+
+    Parameters:
+        csv_file (String): the csv file
+        directory (String): the store directory
+        sources (list<String>): the files to record in the manifest (defaults to the csv file)
+    """
+    write_partitioned_store(directory, read_csv_columns(csv_file), sources or [csv_file])
+
+
+def load_store(directory):
+    """ Memory-maps the columns of a partition
+
+    Parameters:
+        directory (String): the partition directory
+
+    Returns:
+        dict: read-only arrays for each of the COLUMNS
+    """
+    return {name: np.load(os.path.join(directory, name + ".npy"), mmap_mode="r") for name in COLUMNS}
+
+
+class Partition(object):
+    """ One month of the dataset, memory-mapped the first time it is used """
+
+    def __init__(self, directory, key, first_date, last_date, rows):
+        """
+        Parameters:
+            directory (String): the store directory
+            key (String): the partition name, e.g. 2006-10
+            first_date (String): the first day in the partition
+            last_date (String): the last day in the partition
+            rows (int): the number of rows in the partition
+        """
+        self.directory = os.path.join(directory, key)
+        self.key = key
+        self.first_date = np.datetime64(first_date, "D")
+        self.last_date = np.datetime64(last_date, "D")
+        self.rows = rows
+
+        self.columns = None
+        self.row_ranges = None
+        self.lock = threading.Lock()
+
+    def overlaps(self, start_date=None, end_date=None):
+        """ Checks whether the partition holds any days in a date range
+
+        Parameters:
+            start_date (datetime64): the first day of the range (None for no lower bound)
+            end_date (datetime64): the last day of the range (None for no upper bound)
+
+        Returns:
+            bool: True if the partition should be read for the range
+        """
+        return (start_date is None or self.last_date >= start_date) and \
+            (end_date is None or self.first_date <= end_date)
+
+    def load(self):
+        """ Memory-maps the columns and indexes the rows of each (site, location), if not already done """
+        with self.lock:
+            if self.columns is not None:
+                return
+
+            columns = load_store(self.directory)
+            sites, locations = columns["sites"], columns["locations"]
+
+            # The partition is sorted by site and location, so each pair is a contiguous range of rows
+            boundaries = np.flatnonzero((np.diff(sites) != 0) | (np.diff(locations) != 0)) + 1
+            starts = np.concatenate(([0], boundaries)).astype(int)
+            stops = np.concatenate((boundaries, [len(sites)])).astype(int)
+            row_ranges = {}
+            if len(sites):
+                for start, stop in zip(starts, stops):
+                    row_ranges[(int(sites[start]), int(locations[start]))] = (start, stop)
+
+            self.row_ranges = row_ranges
+            self.columns = columns
+
+    def get_column(self, name):
+        """ Gets one of the COLUMNS
+
+        Parameters:
+            name (String): the column name
+
+        Returns:
+            array: the (memory-mapped) column
+        """
+        self.load()
+
+        return self.columns[name]
+
+    def get_rows(self, scats_number, location, start_date=None, end_date=None):
+        """ Finds the rows holding a location's data over a date range
+
+        Parameters:
+            scats_number (int): the scats site identifier
+            location (int): the VicRoads internal id/direction for the location
+            start_date (datetime64): the first day to include (None for no lower bound)
+            end_date (datetime64): the last day to include (None for no upper bound)
+
+        Returns:
+            int: the first row
+            int: the row after the last row
+        """
+        self.load()
+        start, stop = self.row_ranges.get((scats_number, location), (0, 0))
+
+        if start_date is not None or end_date is not None:
+            dates = self.columns["dates"][start:stop]
+            if end_date is not None:
+                stop = start + int(np.searchsorted(dates, end_date, side="right"))
+            if start_date is not None:
+                start = start + int(np.searchsorted(dates, start_date, side="left"))
+
+        return start, max(start, stop)
+
+
+class PartitionedColumn(object):
+    """ A column of the whole dataset, read through the memory maps of the partitions rather than joined into memory
+
+    Rows are numbered across the partitions in order, and indexing copies only the rows that are asked for.
+    """
+
+    def __init__(self, parts):
+        """
+        Parameters:
+            parts (list<array>): the column of each partition, in order
+        """
+        self.parts = parts
+        # The global row each partition starts at, and the total number of rows at the end
+        self.offsets = np.cumsum([0] + [len(part) for part in parts])
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    @property
+    def shape(self):
+        return (len(self),) + self.parts[0].shape[1:]
+
+    @property
+    def ndim(self):
+        return self.parts[0].ndim
+
+    @property
+    def dtype(self):
+        return self.parts[0].dtype
+
+    def __array__(self, dtype=None, copy=None):
+        # Joins the whole column into memory, only for callers that really need all of it
+        column = np.concatenate(self.parts)
+        return column if dtype is None else column.astype(dtype)
+
+    def locate(self, rows):
+        """ Maps global rows to the partitions holding them
+
+        Parameters:
+            rows (array): the global row numbers
+
+        Returns:
+            array: the partition of each row
+            array: the row within its partition
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        rows = np.where(rows < 0, rows + len(self), rows)
+        if rows.size and (rows.min() < 0 or rows.max() >= len(self)):
+            raise IndexError("row index out of range for a column of {0} rows".format(len(self)))
+
+        part_index = np.searchsorted(self.offsets, rows, side="right") - 1
+        return part_index, rows - self.offsets[part_index]
+
+    def __getitem__(self, key):
+        rows, rest = (key[0], key[1:]) if isinstance(key, tuple) else (key, ())
+
+        if isinstance(rows, slice):
+            rows = np.arange(len(self))[rows]
+        elif np.isscalar(rows):
+            part_index, local_rows = self.locate(rows)
+            return self.parts[int(part_index)][(int(local_rows),) + rest]
+
+        rows = np.asarray(rows)
+        part_index, local_rows = self.locate(rows.reshape(-1))
+        # Indices after the row that are matched element-wise with the rows are split between the partitions too
+        matched = [np.asarray(index).reshape(-1) if np.ndim(index) and np.size(index) == rows.size else None
+                   for index in rest]
+
+        result = None
+        for i in np.unique(part_index).tolist():
+            mask = part_index == i
+            part_key = (local_rows[mask],) + tuple(index if index_rows is None else index_rows[mask]
+                                                   for index, index_rows in zip(rest, matched))
+            values = self.parts[i][part_key]
+            if result is None:
+                result = np.empty((rows.size,) + values.shape[1:], dtype=values.dtype)
+            result[mask] = values
+
+        if result is None:
+            result = self.parts[0][(local_rows,) + rest]
+        return result.reshape(rows.shape + result.shape[1:])
@@ -0,0 +1,302 @@
+import argparse
+import glob
+import hashlib
+import json
+import os
+import sys
+
+import numpy as np
+
+from data import store
+from data.data import TRAIN_DAYS, get_first_test_day
+from data.scats import get_scats_data
+from model.manifest import get_model_signature
+from utility import convert_dates_to_days_of_week
+
+FORECAST_DIRECTORY = "data/cache/forecasts"
+# Bumped whenever the layout of the tables changes
+FORECAST_FORMAT = 2
+# A week of days used to ask the generalised model for each day of the week (2006-10-02 was a Monday)
+GENERALISED_WEEK = np.datetime64("2006-10-02", "D") + np.arange(7)
+
+
+def get_model_file(network_type, generalised, scats_number=None, junction=None):
+    """ Gets the file of the model that forecasts a location
+
+    Parameters:
+        network_type (String): the type of model, e.g. "lstm"
+        generalised (bool): whether the generalised model is used rather than the location's own model
+        scats_number (int): the scats site identifier
+        junction (int): the VicRoads internal id for the location
+
+    Returns:
+        String: the model file
+    """
+    if generalised:
+        return "model/{0}/Generalised/Model.h5".format(network_type)
+
+    return "model/{0}/{1}/{2}.h5".format(network_type, scats_number, junction)
+
+
+def get_weekday_dates(scats_number, junction):
+    """ Chooses the day of the location's data each day of the week is forecast from for its own model
+
+    The first day of each day of the week from the first day after the training days is used, skipping days whose day
+    before is missing from the location's data, as the model is given the volumes leading up to each time.
+
+    Parameters:
+        scats_number (int): the scats site identifier
+        junction (int): the VicRoads internal id for the location
+
+    Returns:
+        list: the date for each day of the week, Monday first (None for days of the week without data)
+    """
+    dates = get_scats_data().get_scats_dates(scats_number, junction)
+    follows = dates[1:] - dates[:-1] == np.timedelta64(1, "D")
+    dates = dates[1:][follows]
+    dates = dates[dates >= get_first_test_day()]
+    days_of_week = convert_dates_to_days_of_week(dates)
+
+    weekday_dates = [None] * 7
+    for date, day_of_week in zip(dates[::-1].tolist(), days_of_week[::-1].tolist()):
+        weekday_dates[day_of_week] = np.datetime64(date, "D")
+    return weekday_dates
+
+
+class ForecastTable(object):
+    """ Volumes forecast ahead of time for every location, day of the week and 15 minute interval of the day
+
+    The forecasts of one type of model are stored as a dense (locations x 7 x 96) array, read through a memory map, with
+    an index of the locations. Each location is stored with a signature of its model and data, so forecasts that are
+    out of date are treated as missing (NaN) and can be predicted live instead.
+    """
+
+    def __init__(self, network_type, generalised=False, directory=FORECAST_DIRECTORY):
+        """
+        Parameters:
+            network_type (String): the type of model, e.g. "lstm"
+            generalised (bool): whether the forecasts are from the generalised model rather than each location's own
+            directory (String): the directory the tables are stored in
+        """
+        self.network_type = network_type
+        self.generalised = generalised
+        self.directory = directory
+        self.name = "{0}-{1}".format(network_type, "generalised" if generalised else "individual")
+
+        # The memory-mapped forecasts and (scats_number, location) -> row, read by open
+        self.volumes = None
+        self.index = {}
+        # Whether each row still matches its model and data (None until the table is opened)
+        self.current = None
+
+    def get_array_file(self):
+        return os.path.join(self.directory, self.name + ".npy")
+
+    def get_index_file(self):
+        return os.path.join(self.directory, self.name + ".json")
+
+    def get_signatures(self, junctions):
+        """ Describes everything the forecasts of each location are made from
+
+        Parameters:
+            junctions (list<tuple>): the (scats_number, location) pairs
+
+        Returns:
+            list<String>: a hash for each location that changes when its forecasts need to be made again
+        """
+        scats_data = get_scats_data()
+        if self.generalised:
+            model_signature = get_model_signature(get_model_file(self.network_type, True))
+
+        signatures = []
+        for scats_number, junction in junctions:
+            if not self.generalised:
+                model_signature = get_model_signature(get_model_file(self.network_type, False, scats_number,
+                                                                     junction))
+
+            details = [FORECAST_FORMAT, self.network_type, self.generalised, model_signature, TRAIN_DAYS,
+                       scats_data.get_data_version(scats_number)]
+            signatures.append(hashlib.sha1(json.dumps(details).encode("utf-8")).hexdigest())
+
+        return signatures
+
+    def read_index(self):
+        """ Reads the index of the stored table
+
+        Returns:
+            dict: the locations ("scats-location") and their signatures (None if there is no table)
+        """
+        if not os.path.exists(self.get_index_file()) or not os.path.exists(self.get_array_file()):
+            return None
+
+        with open(self.get_index_file(), "r") as f:
+            index = json.load(f)
+
+        return index if index.get("format") == FORECAST_FORMAT else None
+
+    def open(self):
+        """ Maps the stored table into memory and finds which of its rows are still current
+
+        Returns:
+            bool: whether there is a table
+        """
+        index = self.read_index()
+        if index is None:
+            self.volumes, self.index, self.current = None, {}, np.zeros(0, dtype=bool)
+            return False
+
+        junctions = [tuple(int(part) for part in key.split("-")) for key in index["locations"]]
+        self.volumes = np.load(self.get_array_file(), mmap_mode="r")
+        self.index = {junction: row for row, junction in enumerate(junctions)}
+        self.current = np.array([stored == signature for stored, signature in
+                                 zip(index["signatures"], self.get_signatures(junctions))], dtype=bool)
+        return True
+
+    def lookup(self, scats_number, junction, weekday, intervals=slice(None)):
+        """ Reads forecasts for a location from the table
+
+        Parameters:
+            scats_number (int): the scats site identifier
+            junction (int): the VicRoads internal id for the location
+            weekday (int): the day of the week, with Monday as 0
+            intervals (array): the 15 minute intervals of the day (0-95) to read (defaults to the whole day)
+
+        Returns:
+            array: the forecast volumes, NaN where the forecast is missing or out of date
+        """
+        if self.current is None:
+            self.open()
+
+        row = self.index.get((int(scats_number), int(junction)))
+        if row is None or not self.current[row]:
+            return np.full(np.shape(np.arange(96)[intervals]), np.nan)
+
+        return np.array(self.volumes[row, weekday, intervals], dtype=np.float64)
+
+    def lookup_many(self, junctions, weekday):
+        """ Reads the whole day of forecasts for many locations from the table
+
+        Parameters:
+            junctions (list<tuple>): the (scats_number, location) pairs
+            weekday (int): the day of the week, with Monday as 0
+
+        Returns:
+            array: the (junctions x 96) forecast volumes, NaN where the forecast is missing or out of date
+        """
+        if self.current is None:
+            self.open()
+
+        rows = np.array([self.index.get((int(scats_number), int(junction)), -1) for scats_number, junction in junctions],
+                        dtype=np.int64)
+        found = rows >= 0
+        found[found] = self.current[rows[found]]
+
+        volumes = np.full((len(junctions), 96), np.nan)
+        if found.any():
+            volumes[found] = self.volumes[rows[found], weekday]
+        return volumes
+
+    def build(self, junctions=None, force=False):
+        """ Forecasts every location for every day of the week, reusing the forecasts that are still current
+
+        Parameters:
+            junctions (list<tuple>): the (scats_number, location) pairs (defaults to every location)
+            force (bool): forecast every location again
+
+        Returns:
+            int: the number of locations that were forecast
+        """
+        # Imported here as the predictor depends on this module
+        from predictor import Predictor
+
+        if junctions is None:
+            junctions = get_scats_data().get_junctions()
+        signatures = self.get_signatures(junctions)
+
+        volumes = np.full((len(junctions), 7, 96), np.nan, dtype=np.float32)
+        stale = np.ones(len(junctions), dtype=bool)
+        if not force and self.open():
+            for i, junction in enumerate(junctions):
+                row = self.index.get(junction)
+                if row is not None and self.current[row]:
+                    volumes[i] = self.volumes[row]
+                    stale[i] = False
+        # Let go of the old table before it is replaced, it is opened again by the next lookup
+        self.volumes, self.current = None, None
+
+        stale_junctions = [junction for junction, is_stale in zip(junctions, stale.tolist()) if is_stale]
+        if self.generalised:
+            predictor = Predictor(get_model_file(self.network_type, True), self.network_type)
+            if predictor.model is not None and stale_junctions:
+                volumes[stale] = predictor.predict_generalised(stale_junctions, GENERALISED_WEEK[:, np.newaxis],
+                                                               np.arange(96))
+        else:
+            predictor = Predictor(None, self.network_type)
+            for i in np.flatnonzero(stale).tolist():
+                scats_number, junction = junctions[i]
+                if not os.path.exists(get_model_file(self.network_type, False, scats_number, junction)):
+                    continue
+                for weekday, date in enumerate(get_weekday_dates(scats_number, junction)):
+                    if date is None:
+                        continue
+                    try:
+                        volumes[i, weekday] = predictor.predict_individual(scats_number, junction, range(96), date)
+                    except (OSError, ValueError):
+                        pass
+
+        self.write(junctions, volumes, signatures)
+        return int(stale.sum())
+
+    def write(self, junctions, volumes, signatures):
+        """ Replaces the stored table and its index
+
+        Parameters:
+            junctions (list<tuple>): the (scats_number, location) pairs
+            volumes (array): the (junctions x 7 x 96) forecast volumes
+            signatures (list<String>): the signature of each location, from get_signatures
+        """
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+        store.save_array(self.directory, self.name, volumes.astype(np.float32))
+
+        index = {
+            "format": FORECAST_FORMAT,
+            "locations": ["{0}-{1}".format(scats_number, junction) for scats_number, junction in junctions],
+            "signatures": signatures
+        }
+        temp_filepath = "{0}.{1}.tmp".format(self.get_index_file(), os.getpid())
+        with open(temp_filepath, "w") as f:
+            json.dump(index, f)
+        os.replace(temp_filepath, self.get_index_file())
+
+
+def get_network_types():
+    """ Lists the types of model that have been trained """
+    return sorted({os.path.normpath(model_file).split(os.sep)[1] for model_file in glob.glob("model/*/*/*.h5")})
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--model",
+        action="append",
+        default=None,
+        help="Model to forecast with (can be repeated, defaults to every trained model).")
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Forecast every location again.")
+    args = parser.parse_args()
+
+    for network_type in args.model or get_network_types():
+        for generalised in (False, True):
+            table = ForecastTable(network_type, generalised)
+            if generalised and not os.path.exists(get_model_file(network_type, True)):
+                continue
+            print("Forecasting with the {0} models...".format(table.name))
+            print("Forecast {0} locations".format(table.build(force=args.force)))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -6,13 +6,13 @@ import warnings
 
 import matplotlib as mpl
 import matplotlib.pyplot as plt
-import numpy as np
 import pandas as pd
 from keras.models import load_model
 from keras.utils.vis_utils import plot_model
 from sklearn import metrics
 
 from data.data import process_data
+from model.manifest import ModelManifest
 from utility import get_setting
 
 warnings.filterwarnings("ignore")
@@ -159,6 +159,7 @@ def main(argv):
     args = parser.parse_args()
 
     models = []
+    manifests = []
     untrained_models = []
     model_names = ['LSTM', 'GRU', 'SAEs', 'FEEDFWD', 'DEEPFEEDFWD']
 
@@ -170,6 +171,7 @@ def main(argv):
 
         if os.path.exists(file):
             models.append(load_model(file))
+            manifests.append(ModelManifest.find(file, models[-1]))
         else:
             untrained_models.append(name)
 
@@ -183,11 +185,9 @@ def main(argv):
 
     y_preds = []
     mtx = []
-    for name, model in zip(model_names, models):
-        if name == 'SAEs':
-            x_test = np.reshape(x_test, (x_test.shape[0], x_test.shape[1]))
-        else:
-            x_test = np.reshape(x_test, (x_test.shape[0], x_test.shape[1], 1))
+    for name, model, manifest in zip(model_names, models, manifests):
+        manifest.check(model, lag=lag)
+        x_test = manifest.reshape_input(x_test)
         file = 'images/' + name + '.png'
         plot_model(model, to_file=file, show_shapes=True)
         predicted = model.predict(x_test)
@@ -0,0 +1,196 @@
+import json
+import os
+import warnings
+
+import numpy as np
+
+from data import store
+from data.scaler import Scaler
+
+# Bumped whenever the layout of the manifest changes
+MANIFEST_VERSION = 1
+
+
+def get_manifest_file(model_file):
+    """ Gets the file a model's manifest is saved in, next to the model
+
+    Parameters:
+        model_file (String): the model file, e.g. "model/gru/970/1.h5"
+
+    Returns:
+        String: the manifest file, e.g. "model/gru/970/1.manifest.json"
+    """
+    return os.path.splitext(model_file)[0] + ".manifest.json"
+
+
+def get_model_signature(model_file):
+    """ Describes a model file and its manifest so retrained models can be detected
+
+    Parameters:
+        model_file (String): the model file
+
+    Returns:
+        list: the signatures of the files that exist
+    """
+    return [store.file_signature(filepath)
+            for filepath in (model_file, get_manifest_file(model_file))
+            if os.path.exists(filepath)]
+
+
+def get_input_shape(model):
+    """ Gets the shape of a single input of a model (without the batch dimension) """
+    return [int(size) for size in model.input_shape[1:]]
+
+
+def get_keras_version():
+    """ Gets the version of Keras that is installed (None if it is not) """
+    try:
+        import keras
+    except ImportError:
+        return None
+    return keras.__version__
+
+
+class ModelManifest(object):
+    """ Describes how a saved model has to be used: the shape of its input, the lag and the scale of its data
+
+    The manifest is written next to the model when it is saved, so a model can be given correctly shaped, scaled
+    input on the first try, and checked against what it is being used for without running it.
+    """
+
+    def __init__(self, network_type, input_shape, lag=None, scaler=None, data_hash=None, keras_version=None):
+        """
+        Parameters:
+            network_type (String): the kind of network, e.g. "gru"
+            input_shape (list): the shape of a single input (without the batch dimension), e.g. [12, 1]
+            lag (int): the number of earlier volumes the model is given (None for the generalised models)
+            scaler (Scaler): the scaler the training data was scaled with
+            data_hash (String): identifies the data the model was trained on (the version of its data)
+            keras_version (String): the version of Keras the model was saved with
+        """
+        self.network_type = network_type
+        self.input_shape = [int(size) for size in input_shape]
+        self.lag = lag
+        self.scaler = scaler
+        self.data_hash = data_hash
+        self.keras_version = keras_version
+
+    @classmethod
+    def from_model(cls, model, network_type, lag=None, scaler=None, data_hash=None):
+        """ Describes a model that is about to be saved
+
+        Parameters:
+            model (Model): the trained model
+            network_type (String): the kind of network, e.g. "gru"
+            lag (int): the number of earlier volumes the model is given (None for the generalised models)
+            scaler (Scaler): the scaler the training data was scaled with
+            data_hash (String): identifies the data the model was trained on
+
+        Returns:
+            ModelManifest: the manifest
+        """
+        return cls(network_type, get_input_shape(model), lag, scaler, data_hash, get_keras_version())
+
+    def reshape_input(self, data):
+        """ Shapes a batch of inputs the way the model expects them
+
+        Parameters:
+            data (array): the inputs, one row per sample
+
+        Returns:
+            array: the reshaped inputs
+        """
+        return np.reshape(data, [len(data)] + self.input_shape)
+
+    def check(self, model, network_type=None, lag=None):
+        """ Makes sure a model matches its manifest and what it is about to be used for
+
+        Parameters:
+            model (Model): the loaded model
+            network_type (String): the kind of network the model is expected to be (None to skip the check)
+            lag (int): the lag the model is expected to use (None to skip the check)
+        """
+        if get_input_shape(model) != self.input_shape:
+            raise ValueError("The model takes inputs of shape {0}, but its manifest says {1}".format(
+                get_input_shape(model), self.input_shape))
+        if None not in (network_type, self.network_type) and network_type != self.network_type:
+            raise ValueError("The model is a {0} model, not a {1} model".format(self.network_type, network_type))
+        if None not in (lag, self.lag) and lag != self.lag:
+            raise ValueError("The model uses a lag of {0}, not {1}".format(self.lag, lag))
+
+        keras_version = get_keras_version()
+        if None not in (self.keras_version, keras_version) and \
+                self.keras_version.split(".")[0] != keras_version.split(".")[0]:
+            warnings.warn("The model was saved with Keras {0}, but Keras {1} is installed".format(
+                self.keras_version, keras_version))
+
+    def save(self, filepath):
+        """ Writes the manifest to a JSON file
+
+        Parameters:
+            filepath (String): the file to write to
+        """
+        directory = os.path.dirname(filepath)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        contents = {
+            "version": MANIFEST_VERSION,
+            "network_type": self.network_type,
+            "input_shape": self.input_shape,
+            "lag": self.lag,
+            "scaler": None if self.scaler is None else {
+                "minimum": self.scaler.minimum.tolist(),
+                "data_range": self.scaler.data_range.tolist()
+            },
+            "data_hash": self.data_hash,
+            "keras_version": self.keras_version
+        }
+        temp_filepath = "{0}.{1}.tmp".format(filepath, os.getpid())
+        with open(temp_filepath, "w") as f:
+            json.dump(contents, f, indent=2)
+        os.replace(temp_filepath, filepath)
+
+    @classmethod
+    def load(cls, filepath):
+        """ Reads a manifest written by save
+
+        Parameters:
+            filepath (String): the file to read
+
+        Returns:
+            ModelManifest: the manifest
+        """
+        with open(filepath, "r") as f:
+            contents = json.load(f)
+
+        if contents.get("version") != MANIFEST_VERSION:
+            raise ValueError("{0} is version {1} of the manifest, not {2}".format(
+                filepath, contents.get("version"), MANIFEST_VERSION))
+
+        scaler = contents["scaler"]
+        if scaler is not None:
+            scaler = Scaler(scaler["minimum"], scaler["data_range"])
+
+        return cls(contents["network_type"], contents["input_shape"], contents["lag"], scaler, contents["data_hash"],
+                   contents["keras_version"])
+
+    @classmethod
+    def find(cls, model_file, model=None, network_type=None):
+        """ Reads the manifest saved next to a model, or describes the model itself if it was saved without one
+
+        Parameters:
+            model_file (String): the model file
+            model (Model): the loaded model (used when there is no manifest)
+            network_type (String): the kind of network the model is (used when there is no manifest)
+
+        Returns:
+            ModelManifest: the manifest (None when there is no manifest and no model to describe)
+        """
+        manifest_file = get_manifest_file(model_file)
+        if os.path.exists(manifest_file):
+            return cls.load(manifest_file)
+        if model is None:
+            return None
+
+        return cls(network_type, get_input_shape(model))
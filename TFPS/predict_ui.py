@@ -4,14 +4,12 @@ import threading
 from PyQt5 import QtCore, QtGui, QtWidgets
 from sklearn.preprocessing import MinMaxScaler
 
-from data.scats import ScatsData
+from data.scats import get_scats_data
 from predictor import Predictor
 from train import train_with_args
 from utility import ConsoleStream, get_setting
 
 
-SCATS_DATA = ScatsData()
-
 DEFAULT_FONT = QtGui.QFont()
 DEFAULT_FONT.setFamily("Arial")
 DEFAULT_FONT.setPointSize(10)
@@ -169,16 +167,17 @@ class UIPredict(object):
         for model in models:
             self.model_combo_box.addItem(model)
 
-        scats_numbers = SCATS_DATA.get_all_scats_numbers()
+        scats_data = get_scats_data()
+        scats_numbers = scats_data.get_all_scats_numbers()
 
         self.scats_number_combo_box.addItem("")
         self.junction_combo_box.addItem("")
         for scats in scats_numbers:
             self.scats_number_combo_box.addItem(str(scats))
-            self.scats_info[str(scats)] = SCATS_DATA.get_scats_approaches(scats)
+            self.scats_info[str(scats)] = scats_data.get_scats_approaches(scats)
             i = 0
             for location in self.scats_info[str(scats)]:
-                self.scats_info[str(scats)][i] = SCATS_DATA.get_location_name(scats, location)
+                self.scats_info[str(scats)][i] = scats_data.get_location_name(scats, location)
                 i += 1
         self.junction_combo_box.setEnabled(False)
         self.junction_label.setVisible(False)
@@ -235,8 +234,8 @@ class UIPredict(object):
             model_file = f"model/{network_type}/Generalised/Model.h5"
             if os.path.isfile(model_file):
                 predictor = Predictor(model_file, network_type)
-                junction_id = int(SCATS_DATA.get_location_id(junction_combo_value))
-                lat, long = SCATS_DATA.get_positional_data(scats_number, junction_id)
+                junction_id = int(get_scats_data().get_location_id(junction_combo_value))
+                lat, long = get_scats_data().get_positional_data(scats_number, junction_id)
                 input = [{
                     "latitude": lat,
                     "longitude": long,
@@ -249,7 +248,7 @@ class UIPredict(object):
             else:
                 self.text_output.setText("Model file not found")
         elif self.model_type == "Junction":
-            junction_id = int(SCATS_DATA.get_location_id(junction_combo_value))
+            junction_id = int(get_scats_data().get_location_id(junction_combo_value))
             model_file = f"model/{network_type}/{scats_number}/{junction_id}.h5"
             if os.path.isfile(model_file):
                 predictor = Predictor(model_file, network_type)
@@ -1,69 +1,421 @@
 import os
+import threading
+from collections import OrderedDict
 
 import numpy as np
 from tensorflow.python.keras.models import load_model
 
 import utility
-from data.data import process_data
-from data.scats import ScatsData
+from data.data import get_first_test_day
+from data.scaler import Scaler
+from data.scats import get_scats_data
+from forecast import GENERALISED_WEEK, ForecastTable, get_weekday_dates
+from model.manifest import ModelManifest
 
-SCATS_DATA = ScatsData()
+# The most models kept loaded at once, and the most memory their weights can use (None for no limit)
+MODEL_CACHE_SIZE = 64
+MODEL_CACHE_BYTES = None
+# The number of rows the model is run on at a time by make_predictions
+PREDICTION_BATCH_SIZE = 8192
+
+
+class ModelCache(object):
+    """ Keeps the most recently used models loaded, so each model file is only read once
+
+    Models are keyed by their path and modification time, so a retrained model is loaded again. Concurrent requests
+    for the same model wait for a single load. Each model is kept with its manifest, which is checked against the model
+    once when it is loaded.
+    """
+
+    def __init__(self, max_models=MODEL_CACHE_SIZE, max_bytes=MODEL_CACHE_BYTES):
+        """
+        Parameters:
+            max_models (int): the most models kept loaded
+            max_bytes (int): the most memory the weights of the loaded models can use (None for no limit)
+        """
+        self.max_models = max_models
+        self.max_bytes = max_bytes
+
+        # (path, modification time) -> (model, manifest, size of its weights), least recently used first
+        self.models = OrderedDict()
+        # (path, modification time) -> the lock held while the model is being loaded
+        self.loading = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, filepath):
+        """ Gets a model, loading it if it is not already loaded
+
+        Parameters:
+            filepath (String): the model file
+
+        Returns:
+            Model: the model
+        """
+        return self.get_with_manifest(filepath)[0]
+
+    def get_with_manifest(self, filepath):
+        """ Gets a model and its manifest, loading them if they are not already loaded
+
+        Parameters:
+            filepath (String): the model file
+
+        Returns:
+            Model: the model
+            ModelManifest: the manifest saved with the model (or a description of the model if it has none)
+        """
+        path = os.path.abspath(filepath)
+        key = (path, os.stat(path).st_mtime_ns)
+
+        with self.lock:
+            if key in self.models:
+                self.hits += 1
+                self.models.move_to_end(key)
+                return self.models[key][:2]
+            loading_lock = self.loading.setdefault(key, threading.Lock())
+
+        with loading_lock:
+            with self.lock:
+                # Another thread may have loaded it while this one was waiting
+                if key in self.models:
+                    self.hits += 1
+                    self.models.move_to_end(key)
+                    return self.models[key][:2]
+                self.misses += 1
+
+            try:
+                model = load_model(path)
+                manifest = ModelManifest.find(path, model)
+                manifest.check(model)
+                size = sum(weights.nbytes for weights in model.get_weights())
+            except BaseException:
+                with self.lock:
+                    self.loading.pop(key, None)
+                raise
+
+            with self.lock:
+                # Drop any older version of the file
+                for old_key in [old_key for old_key in self.models if old_key[0] == path]:
+                    del self.models[old_key]
+                self.models[key] = (model, manifest, size)
+                # Only stop sharing the loading lock once the model can be found, so no other thread loads it again
+                self.loading.pop(key, None)
+                self.evict()
+
+        return model, manifest
+
+    def evict(self):
+        """ Unloads the least recently used models until the cache is within its limits (call with the lock held) """
+        while len(self.models) > 1 and (len(self.models) > self.max_models or (
+                self.max_bytes is not None and self.get_size() > self.max_bytes)):
+            self.models.popitem(last=False)
+
+    def get_size(self):
+        """ Gets the memory used by the weights of the loaded models (in bytes) """
+        return sum(size for _, _, size in self.models.values())
+
+    def get_stats(self):
+        """ Describes how well the cache is working
+
+        Returns:
+            dict: the number of hits, misses and loaded models, and the memory used by their weights
+        """
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "models": len(self.models), "bytes": self.get_size()}
+
+    def clear(self):
+        """ Unloads every model """
+        with self.lock:
+            self.models.clear()
+
+
+# The models loaded by every Predictor in the process
+MODEL_CACHE = ModelCache()
 
 
 class Predictor(object):
     model = None
+    manifest = None
+    model_file = None
     network_type = None
 
-    def __init__(self, filepath, network_type):
-        self.load_model(filepath)
+    def __init__(self, filepath, network_type, lookup=False):
+        """
+        Parameters:
+            filepath (String): the generalised model file (None when only the locations' own models are used)
+            network_type (String): the type of model, e.g. "lstm"
+            lookup (bool): answer forecasts from the precomputed tables (see forecast.py), only running the models
+                for forecasts that are missing or out of date (the generalised model is then only loaded once a
+                forecast has to be predicted)
+        """
+        self.model_file = filepath
+        if not lookup:
+            self.load_model(filepath)
         self.network_type = network_type
+        self.lookup = lookup
+        # generalised -> ForecastTable
+        self.forecasts = {}
 
     def load_model(self, filepath):
-        if os.path.exists(filepath):
-            self.model = load_model(filepath)
+        if filepath is not None and os.path.exists(filepath):
+            self.model, self.manifest = MODEL_CACHE.get_with_manifest(filepath)
             return True
         else:
             return False
 
+    def get_model(self):
+        """ Gets the generalised model, loading it the first time it is needed (None if there is no model) """
+        if self.model is None:
+            self.load_model(self.model_file)
+        return self.model
+
     def make_prediction(self, inputs):
+        """ Predicts the volume for a list of inputs with the generalised model, encoded the same way as make_predictions
 
-        model_input = np.zeros((len(inputs), 8))
-        for index, input in enumerate(inputs):
-            model_input[index][0], model_input[index][1] = utility.convert_absolute_coordinates_to_relative(
-                input["latitude"], input["longitude"])
-            model_input[index][2], model_input[index][3] = utility.convert_direction_to_cyclic(input["direction"])
-            model_input[index][4], model_input[index][5] = utility.convert_time_to_cyclic(input["time"])
-            model_input[index][6], model_input[index][7] = utility.convert_date_to_cyclic_day(input["date"])
+        Parameters:
+            inputs (list<dict>): the latitude, longitude, direction (1-8 or N-NW), time (##:##) and date
+                (dd/mm/yyyy) of each row
 
-        model_input = self.reshape_data(model_input)
-        try:
-            prediction = self.model.predict(model_input)
-        except ValueError:
-            model_input = np.reshape(model_input, (model_input.shape[0], model_input.shape[1], 1))
-            prediction = self.model.predict(model_input)
+        Returns:
+            array: the (rows x 1) predictions (the volume divided by the maximum traffic)
+        """
+        prediction = self.make_predictions(
+            [input["latitude"] for input in inputs], [input["longitude"] for input in inputs],
+            [utility.convert_direction_to_number(input["direction"]) for input in inputs],
+            [utility.convert_time_to_interval(input["time"]) for input in inputs],
+            [utility.convert_date_string_to_day(input["date"]) for input in inputs])
 
-        return prediction
+        return prediction.reshape(-1, 1)
 
-    def make_prediction_from_individual(self, scats_number, junction, time):
+    def encode_features(self, latitudes, longitudes, directions, intervals, dates):
+        """ Encodes arrays of inputs into the features of the generalised model, the same way as the training data
 
-        individual_model = load_model(
-            "model/" + self.network_type + "/" + str(scats_number) + "/" + str(junction) + ".h5")
+        Parameters:
+            latitudes (array): the latitude of each row
+            longitudes (array): the longitude of each row
+            directions (array): the direction of each row (1-8, clockwise from north)
+            intervals (array): the 15 minute interval of the day of each row (0-95)
+            dates (array): the day of each row (datetime64, or strings such as "2006-10-01")
 
-        _, _, x_test, _, scaler = process_data(scats_number, junction, 12)
+        Returns:
+            array: the (rows x 8) features
+        """
+        latitudes, longitudes, directions, intervals, dates = np.broadcast_arrays(
+            np.asarray(latitudes, dtype=np.float64), np.asarray(longitudes, dtype=np.float64),
+            np.asarray(directions, dtype=np.int64), np.asarray(intervals, dtype=np.int64),
+            np.asarray(dates, dtype="datetime64[D]"))
 
-        try:
-            predicted = individual_model.predict(x_test)
-        except ValueError:
-            x_test = np.reshape(x_test, (x_test.shape[0], x_test.shape[1], 1))
-            predicted = individual_model.predict(x_test)
-        predicted = scaler.inverse_transform(predicted.reshape(-1, 1)).reshape(1, -1)[0]
-        predicted = predicted[utility.TIME_INTERVALS[time]]
+        features = np.empty((latitudes.size, 8))
+        features[:, 0], features[:, 1] = utility.convert_absolute_coordinates_to_relative(latitudes.reshape(-1),
+                                                                                          longitudes.reshape(-1))
+        features[:, 2], features[:, 3] = utility.convert_directions_to_cyclic(directions.reshape(-1))
+        features[:, 4], features[:, 5] = utility.convert_time_intervals_to_cyclic(intervals.reshape(-1))
+        features[:, 6], features[:, 7] = utility.convert_dates_to_cyclic_days(dates.reshape(-1))
 
-        return int(predicted)
+        return features
 
-    def reshape_data(self, data):
-        if self.network_type == 'seas':
-            reshaped_data = np.reshape(data, (data.shape[0], data.shape[1]))
+    def make_predictions(self, latitudes, longitudes, directions, intervals, dates):
+        """ Predicts the volume for many rows of inputs with a single pass of the generalised model
+
+        The inputs are arrays (or single values, which are used for every row) of the same length.
+
+        Parameters:
+            latitudes (array): the latitude of each row
+            longitudes (array): the longitude of each row
+            directions (array): the direction of each row (1-8, clockwise from north)
+            intervals (array): the 15 minute interval of the day of each row (0-95)
+            dates (array): the day of each row (datetime64, or strings such as "2006-10-01")
+
+        Returns:
+            array: the prediction for each row (the volume divided by the maximum traffic)
+        """
+        model = self.get_model()
+        model_input = self.reshape_data(self.encode_features(latitudes, longitudes, directions, intervals, dates))
+        prediction = model.predict(model_input, batch_size=PREDICTION_BATCH_SIZE)
+
+        return np.reshape(prediction, (-1,))
+
+    def predict_generalised(self, junctions, dates, intervals):
+        """ Predicts the volume of many locations with the generalised model
+
+        Parameters:
+            junctions (list<tuple>): the (scats_number, location) pairs
+            dates (array): the days to predict (datetime64), broadcast against the intervals
+            intervals (array): the 15 minute intervals of the day (0-95) to predict
+
+        Returns:
+            array: the predicted volumes, (junctions x the broadcast shape of the dates and intervals)
+        """
+        scats_data = get_scats_data()
+        positions = np.array([scats_data.get_positional_data(scats_number, location)
+                              for scats_number, location in junctions], dtype=np.float64).reshape(-1, 2)
+        locations = np.array([location for _, location in junctions], dtype=np.int64)
+        shape = np.broadcast(np.asarray(dates, dtype="datetime64[D]"), np.asarray(intervals)).shape
+        columns = (slice(None),) + (np.newaxis,) * len(shape)
+
+        # The generalised model predicts volumes divided by the max traffic
+        predictions = self.make_predictions(positions[:, 0][columns], positions[:, 1][columns], locations[columns],
+                                            intervals, dates)
+        return predictions.reshape((len(junctions),) + shape) * scats_data.MAX_TRAFFIC
+
+    def get_forecasts(self, generalised):
+        """ Gets the table of precomputed forecasts for the type of model
+
+        Parameters:
+            generalised (bool): whether the forecasts are from the generalised model rather than each location's own
+
+        Returns:
+            ForecastTable: the table
+        """
+        if generalised not in self.forecasts:
+            self.forecasts[generalised] = ForecastTable(self.network_type, generalised)
+        return self.forecasts[generalised]
+
+    def forecast(self, scats_number, junction, times, weekday, generalised=False):
+        """ Forecasts the volume of a location at specific times of a day of the week
+
+        In lookup mode the forecasts are read from the precomputed table, and only the missing or out of date ones are
+        predicted by the model.
+
+        Parameters:
+            scats_number (int): the scats site identifier
+            junction (int): the VicRoads internal id for the location
+            times (list): the times of day (##:##) or 15 minute intervals of the day (0-95) to forecast
+            weekday (int): the day of the week, with Monday as 0
+            generalised (bool): use the generalised model rather than the location's own model
+
+        Returns:
+            array: the forecast volume at each of the times
+        """
+        intervals = np.array([utility.TIME_INTERVALS[time] if isinstance(time, str) else int(time) for time in times],
+                             dtype=np.int64)
+
+        if self.lookup:
+            volumes = self.get_forecasts(generalised).lookup(scats_number, junction, weekday, intervals)
         else:
-            reshaped_data = np.reshape(data, (data.shape[0], data.shape[1]))
-        return reshaped_data
+            volumes = np.full(len(intervals), np.nan)
+
+        missing = np.isnan(volumes)
+        if missing.any():
+            if generalised:
+                volumes[missing] = self.predict_generalised([(scats_number, junction)], GENERALISED_WEEK[weekday],
+                                                            intervals[missing])[0]
+            else:
+                date = get_weekday_dates(scats_number, junction)[weekday]
+                if date is None:
+                    raise ValueError("There is no data for {0}-{1} on a {2}".format(
+                        scats_number, junction, utility.DAYS_OF_WEEK[weekday]))
+                volumes[missing] = self.predict_individual(scats_number, junction, intervals[missing], date)
+
+        return volumes
+
+    def forecast_volumes(self, junctions, weekday, generalised=False):
+        """ Forecasts the volume of many locations for every time of a day of the week
+
+        In lookup mode the forecasts are read from the precomputed table, and only the locations whose forecasts are
+        missing or out of date are predicted by the models.
+
+        Parameters:
+            junctions (list<tuple>): the (scats_number, location) pairs
+            weekday (int): the day of the week, with Monday as 0
+            generalised (bool): use the generalised model rather than each location's own model
+
+        Returns:
+            array: the (junctions x 96) forecast volumes, NaN for locations that could not be forecast
+        """
+        if self.lookup:
+            volumes = self.get_forecasts(generalised).lookup_many(junctions, weekday)
+        else:
+            volumes = np.full((len(junctions), 96), np.nan)
+
+        missing = np.flatnonzero(np.isnan(volumes).any(axis=1))
+        if generalised:
+            if len(missing) and self.get_model() is not None:
+                volumes[missing] = self.predict_generalised([junctions[i] for i in missing.tolist()],
+                                                            GENERALISED_WEEK[weekday], np.arange(96))
+        else:
+            for i in missing.tolist():
+                try:
+                    volumes[i] = self.forecast(junctions[i][0], junctions[i][1], range(96), weekday)
+                except (OSError, ValueError):
+                    pass
+
+        return volumes
+
+    def make_prediction_from_individual(self, scats_number, junction, time, date=None):
+        predicted = self.predict_individual(scats_number, junction, [time], date)
+
+        return int(predicted[0])
+
+    def get_individual_scaler(self, scats_number, junction, manifest=None):
+        """ Gets the scale and lag a location's own model was trained with
+
+        Parameters:
+            scats_number (int): the scats site identifier
+            junction (int): the VicRoads internal id for the location
+            manifest (ModelManifest): the manifest saved with the model
+
+        Returns:
+            Scaler: the scaler for the location's volumes
+            int: the time lag
+        """
+        if manifest is not None and manifest.scaler is not None:
+            return manifest.scaler, manifest.lag
+
+        # Models trained before the scale was saved with them used a lag of 12, and only they need the dataset split
+        # (and with it scikit-learn) to recover their scale
+        from data.data import process_data
+
+        _, _, _, _, scaler = process_data(scats_number, junction, 12, quiet=True)
+        return Scaler.from_sklearn(scaler), 12
+
+    def predict_individual(self, scats_number, junction, times, date=None):
+        """ Predicts the volume of a location at specific times of a day using the location's own model
+
+        Only the windows of volumes leading up to the requested times are built, and run through the model as one
+        small batch.
+
+        Parameters:
+            scats_number (int): the scats site identifier
+            junction (int): the VicRoads internal id for the location
+            times (list): the times of day (##:##) or 15 minute intervals of the day (0-95) to predict
+            date (datetime64/String): the day to predict (defaults to the first day after the training days)
+
+        Returns:
+            array: the predicted volume at each of the times
+        """
+        model_file = "model/" + self.network_type + "/" + str(scats_number) + "/" + str(junction) + ".h5"
+        individual_model, manifest = MODEL_CACHE.get_with_manifest(model_file)
+        scaler, lag = self.get_individual_scaler(scats_number, junction, manifest)
+        manifest.check(individual_model, self.network_type, lag)
+
+        scats_data = get_scats_data()
+        date = get_first_test_day() if date is None else np.datetime64(date, "D")
+        dates = scats_data.get_scats_dates(scats_number, junction)
+        day = int(np.searchsorted(dates, date))
+        if day == len(dates) or dates[day] != date:
+            raise ValueError("There is no data for {0}-{1} on {2}".format(scats_number, junction, date))
+
+        intervals = np.array([utility.TIME_INTERVALS[time] if isinstance(time, str) else int(time) for time in times],
+                             dtype=np.int64)
+        # The windows of the earliest times reach back into the days before, which have to be the calendar days
+        # before rather than just the rows before, as the location can be missing days
+        days_back = int(-((intervals.min() - lag) // 96))
+        if days_back > 0 and (day < days_back or dates[day - days_back] != date - np.timedelta64(days_back, "D")):
+            raise ValueError("There are not enough earlier volumes to predict {0}-{1} on {2}".format(
+                scats_number, junction, date))
+
+        # The positions of the requested times in the location's series of volumes
+        targets = day * 96 + intervals
+        volume_data = scats_data.get_scats_volume(scats_number, junction, flat=True)
+        if targets.max() >= len(volume_data):
+            raise ValueError("There is no data for {0}-{1} at the times asked for".format(scats_number, junction))
+        model_input = scaler.transform(volume_data[targets[:, np.newaxis] - lag + np.arange(lag)])
+        predicted = individual_model.predict(manifest.reshape_input(model_input))
+
+        return scaler.inverse_transform(np.reshape(predicted, (-1,)))
+
+    def reshape_data(self, data):
+        # The manifest knows whether the model takes (samples x features) or (samples x features x 1)
+        return self.manifest.reshape_input(data)
@@ -1,16 +1,26 @@
+import argparse
 import csv
+import hashlib
+import json
+import multiprocessing
 import os
 import queue
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
+import numpy as np
 import pandas as pd
 
-from data.data import get_time_between_points
-from data.scats import ScatsData
+from data.data import get_first_test_day, get_travel_times
+from data.scats import get_scats_data
+from model.manifest import get_model_signature
+from utility import convert_date_string_to_day, convert_dates_to_days_of_week, get_setting
 
-SCATS_DATA = ScatsData()
 
 ROAD_CONNECTIONS_FILE = "data/MappingData.xls"
 DATA_FILE = "data/tfps.csv"
+# Records what each road's times in the data file were estimated from, so only changed roads are recomputed
+DATA_MANIFEST_FILE = "data/tfps.manifest.json"
 
 BIDIRECTIONAL_CONNECTIONS = True
 ADD_ALL_DIRECTIONS = True
@@ -30,6 +40,36 @@ def format_index_to_time(index):
     return '{:02d}:{:02d}'.format(*divmod(minutes, 60))
 
 
+def init_worker(threads):
+    """ Limits the threads TensorFlow uses in a worker process, so the workers don't compete for the cores
+
+    Parameters:
+        threads (int): the number of threads for each worker
+    """
+    os.environ["OMP_NUM_THREADS"] = str(threads)
+    os.environ["TF_NUM_INTRAOP_THREADS"] = str(threads)
+    os.environ["TF_NUM_INTEROP_THREADS"] = "1"
+
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+
+
+def estimate_travel_times(edges, network_type, generalised, date):
+    """ Estimates the travel times of a group of roads for every time of day (run in the worker processes)
+
+    Parameters:
+        edges (array): (edges x 4) origin site, origin location, destination site and destination location
+        network_type (String): the type of model to use
+        generalised (bool): use the generalised model rather than each location's own model
+        date (String): the day to predict
+
+    Returns:
+        array: the (edges x 96) travel times
+    """
+    return get_travel_times(edges, network_type=network_type, generalised=generalised, date=date)
+
+
 class Location(object):
     """ Contains the functionality for the routing capabilities """
 
@@ -56,23 +96,162 @@ class Location(object):
             dataset = pd.read_csv(DATA_FILE, encoding="latin-1", sep=",", header=None)
             self.time_data = pd.DataFrame(dataset)
 
-    def generate_all_data(self):
-        """ Writes all the trained time data to a CSV file """
-        with open(DATA_FILE, "w", newline='') as f:
+    def generate_all_data(self, workers=1, threads=1, network_type=None, generalised=False, date=None, force=False):
+        """ Writes all the trained time data to a CSV file
+
+        Only the roads whose model, speed limit or data changed since the last run are estimated again, spread
+        over a pool of worker processes. The file is replaced in one step, so readers never see a partial table.
+
+        Parameters:
+            workers (int): the number of worker processes (1 estimates in this process)
+            threads (int): the number of TensorFlow threads for each worker
+            network_type (String): the type of model to use (defaults to the "model" setting)
+            generalised (bool): use the generalised model rather than each location's own model
+            date (String): the day to predict, e.g. "23/10/2019" (defaults to the first day after the training
+                days)
+            force (bool): estimate every road again
+        """
+        if network_type is None:
+            network_type = get_setting("model").lower()
+        if date is None:
+            date = pd.Timestamp(get_first_test_day()).strftime("%d/%m/%Y")
+
+        edges = self.get_edges()
+        edge_array = self.get_edge_array()
+        signatures = self.get_edge_signatures(edge_array, network_type, generalised, date)
+
+        # Reuse the times of the roads that have not changed
+        previous = {} if force else self.read_generated_data(signatures)
+        estimated_times = np.zeros((len(edges), 96))
+        changed = []
+        for i, edge in enumerate(edges):
+            if edge in previous:
+                estimated_times[i] = previous[edge]
+            else:
+                changed.append(i)
+        print("Estimating the travel times of {0} of {1} roads".format(len(changed), len(edges)))
+
+        # Each task is every changed road leaving one location, so each model is only run once
+        origins = {}
+        for i in changed:
+            origins.setdefault(edges[i][0], []).append(i)
+        tasks = [(np.array(rows), edge_array[rows]) for rows in origins.values()]
+
+        if workers > 1 and len(tasks) > 1:
+            context = multiprocessing.get_context("spawn")
+            with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=init_worker,
+                                     initargs=(threads,)) as executor:
+                futures = {executor.submit(estimate_travel_times, task_edges, network_type, generalised, date): rows
+                           for rows, task_edges in tasks}
+                for future in as_completed(futures):
+                    rows = futures[future]
+                    estimated_times[rows] = future.result()
+                    print("Recorded the travel times of the roads from {0}".format(edges[rows[0]][0]))
+        else:
+            for rows, task_edges in tasks:
+                estimated_times[rows] = estimate_travel_times(task_edges, network_type, generalised, date)
+                print("Recorded the travel times of the roads from {0}".format(edges[rows[0]][0]))
+
+        self.write_generated_data(edges, estimated_times, signatures)
+
+    def get_edge_signatures(self, edge_array, network_type, generalised, date):
+        """ Describes everything the travel times of each road are estimated from
+
+        Parameters:
+            edge_array (array): the road connections, from get_edge_array
+            network_type (String): the type of model used
+            generalised (bool): whether the generalised model is used
+            date (String): the day predicted, only its day of the week changes the travel times
+
+        Returns:
+            list<String>: a hash for each road that changes when its travel times need to be estimated again
+        """
+        scats_data = get_scats_data()
+        speed_limits = scats_data.get_speed_limits(edge_array)
+        # The volumes are predicted for the day of the week, so days on the same day of the week share their times
+        weekday = int(convert_dates_to_days_of_week(convert_date_string_to_day(date)))
+
+        if generalised:
+            model_signature = get_model_signature("model/{0}/Generalised/Model.h5".format(network_type))
+
+        signatures = []
+        for (o_scats, o_junction, d_scats, d_junction), speed_limit in zip(edge_array.tolist(), speed_limits.tolist()):
+            if not generalised:
+                model_file = "model/{0}/{1}/{2}.h5".format(network_type, o_scats, o_junction)
+                model_signature = get_model_signature(model_file)
+
+            details = [network_type, generalised, weekday, model_signature, speed_limit,
+                       scats_data.get_data_version(o_scats), scats_data.get_data_version(d_scats)]
+            signatures.append(hashlib.sha1(json.dumps(details).encode("utf-8")).hexdigest())
+
+        return signatures
+
+    def read_generated_data(self, signatures):
+        """ Reads the travel times of the roads that have not changed since the data file was written
+
+        Parameters:
+            signatures (list<String>): the current signature of each road, from get_edge_signatures
+
+        Returns:
+            dict: (origin, destination) -> the 96 travel times, for every road that is unchanged
+        """
+        if not os.path.exists(DATA_FILE) or not os.path.exists(DATA_MANIFEST_FILE):
+            return {}
+
+        with open(DATA_MANIFEST_FILE, "r") as f:
+            previous_signatures = json.load(f)
+        current = {edge: signature for edge, signature in zip(self.get_edges(), signatures)
+                   if previous_signatures.get("{0}:{1}".format(*edge)) == signature}
+
+        times = {}
+        with open(DATA_FILE, "r", newline='') as f:
+            for time_of_day, origin, destination, estimated_time in csv.reader(f):
+                if (origin, destination) in current:
+                    times.setdefault((origin, destination), []).append(float(estimated_time))
+
+        return {edge: values for edge, values in times.items() if len(values) == 96}
+
+    def write_generated_data(self, edges, estimated_times, signatures):
+        """ Replaces the data file and its manifest
+
+        Parameters:
+            edges (list<tuple>): the roads, from get_edges
+            estimated_times (array): the (edges x 96) travel times
+            signatures (list<String>): the signature of each road, from get_edge_signatures
+        """
+        temp_filepath = "{0}.{1}.tmp".format(DATA_FILE, os.getpid())
+        with open(temp_filepath, "w", newline='') as f:
             writer = csv.writer(f)
 
             for i in range(96):
-                for scats, roads in self.roads.items():
-                    for road in roads:
-                        origin = scats.split("-")
-                        destination = road.split("-")
+                time_of_day = format_index_to_time(i)
+                for (scats, road), estimated_time in zip(edges, estimated_times[:, i].tolist()):
+                    writer.writerow([time_of_day, scats, road, str(estimated_time)])
+        os.replace(temp_filepath, DATA_FILE)
+
+        manifest = {"{0}:{1}".format(*edge): signature for edge, signature in zip(edges, signatures)}
+        temp_filepath = "{0}.{1}.tmp".format(DATA_MANIFEST_FILE, os.getpid())
+        with open(temp_filepath, "w") as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(temp_filepath, DATA_MANIFEST_FILE)
+
+    def get_edges(self):
+        """ Lists every road connection, the position of a connection in the list is its edge id
+
+        Returns:
+            list<tuple>: the (origin, destination) intersections of each connection
+        """
+        return [(origin, destination) for origin, destinations in self.roads.items() for destination in destinations]
+
+    def get_edge_array(self):
+        """ Gets the road connections as an array, aligned with get_edges
 
-                        time_of_day = format_index_to_time(i)
-                        estimated_time = get_time_between_points(int(origin[0]), int(origin[1]),
-                                                                 int(destination[0]), int(destination[1]), time_of_day)
+        Returns:
+            array: (edges x 4) origin site, origin location, destination site and destination location
+        """
+        edges = [origin.split("-") + destination.split("-") for origin, destination in self.get_edges()]
 
-                        writer.writerow([time_of_day, scats, road, str(estimated_time)])
-                        print("Recorded time to travel between {0} and {1} at {2}".format(scats, road, time_of_day))
+        return np.array(edges, dtype=np.int64).reshape(-1, 4)
 
     def remove_connection(self, intersection1, intersection2):
         """ Removes a road connection
@@ -107,7 +286,7 @@ class Location(object):
             location (String): the intersection
         """
         loc = location.split("-")
-        directions = SCATS_DATA.get_scats_approaches(int(loc[0]))
+        directions = get_scats_data().get_scats_approaches(int(loc[0]))
 
         for direction in directions:
             intersection = "{0}-{1}".format(loc[0], direction)
@@ -291,3 +470,40 @@ class Location(object):
     def debug_print(self):
         """ Prints the connected roads list """
         print(self.roads)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--workers",
+        default=os.cpu_count(),
+        type=int,
+        help="Number of worker processes.")
+    parser.add_argument(
+        "--threads",
+        default=1,
+        type=int,
+        help="Number of TensorFlow threads for each worker.")
+    parser.add_argument(
+        "--model",
+        default=None,
+        help="Model to estimate the volumes with.")
+    parser.add_argument(
+        "--generalised",
+        action="store_true",
+        help="Use the generalised model.")
+    parser.add_argument(
+        "--date",
+        default=None,
+        help="Day to predict (dd/mm/yyyy, defaults to the first day after the training days).")
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Estimate every road again.")
+    args = parser.parse_args()
+
+    Location().generate_all_data(args.workers, args.threads, args.model, args.generalised, args.date, args.force)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,90 @@
+import json
+import shutil
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from data.osm import OsmSpeedLimits, bounding_box
+from data.scats import get_scats_data
+
+# A single way of Warrigal Road, in the Overpass JSON format
+RESPONSE = {
+    "elements": [{
+        "type": "way",
+        "id": 1,
+        "tags": {"name": "Warrigal Road", "maxspeed": "70"},
+        "geometry": [{"lat": -37.86, "lon": 145.09}, {"lat": -37.87, "lon": 145.09}]
+    }]
+}
+BBOX = bounding_box(-37.86, 145.09, -37.87, 145.09)
+
+
+class OverpassStub(BaseHTTPRequestHandler):
+    """ Answers every query with RESPONSE, counting the queries on the server """
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.server.queries += 1
+
+        body = json.dumps(RESPONSE).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestOsmSpeedLimits(unittest.TestCase):
+    """ Looks up speed limits against a local stand-in for the Overpass server """
+
+    def setUp(self):
+        self.server = HTTPServer(("127.0.0.1", 0), OverpassStub)
+        self.server.queries = 0
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.endpoint = "http://127.0.0.1:{0}/api/interpreter".format(self.server.server_port)
+        self.cache_directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.cache_directory, ignore_errors=True)
+
+    def test_speed_limit_is_cached(self):
+        osm = OsmSpeedLimits(self.cache_directory, self.endpoint, timeout=5, rate=100)
+        try:
+            self.assertEqual(osm.get_speed_limit("Warrigal", "Warrigal Road", BBOX, 60), 70)
+            self.assertEqual(osm.get_speed_limit("Warrigal", "Warrigal Road", BBOX, 60), 70)
+        finally:
+            osm.close()
+
+        self.assertEqual(self.server.queries, 1)
+
+    def test_offline_only_reads_the_cache(self):
+        osm = OsmSpeedLimits(self.cache_directory, self.endpoint, offline=True)
+
+        self.assertEqual(osm.get_speed_limit("Warrigal", "Warrigal Road", BBOX, 60), 60)
+        self.assertEqual(self.server.queries, 0)
+
+    def test_settings_changed_after_loading(self):
+        scats_data = get_scats_data()
+        scats_data.OSM_ENDPOINT = self.endpoint
+        scats_data.OSM_CACHE_DIRECTORY = self.cache_directory
+        try:
+            osm = scats_data.get_osm()
+            self.assertEqual(osm.client.endpoint, self.endpoint)
+            self.assertEqual(osm.get_speed_limit("Warrigal", "Warrigal Road", BBOX, 60), 70)
+
+            scats_data.OSM_OFFLINE = True
+            self.assertIsNot(scats_data.get_osm(), osm)
+            self.assertTrue(scats_data.get_osm().offline)
+        finally:
+            del scats_data.OSM_ENDPOINT, scats_data.OSM_CACHE_DIRECTORY, scats_data.OSM_OFFLINE
+            scats_data.get_osm().close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -8,49 +8,77 @@ import pandas as pd
 from keras.models import Model
 
 from data.data import process_data
-from data.scats import ScatsData
+from data.scaler import Scaler
+from data.scats import get_scats_data
+from data.sequence import TrainingSequence
 from utility import get_setting
 from model import model
+from model.manifest import ModelManifest, get_manifest_file
 
 from tensorflow.python.keras.models import load_model
 
 warnings.filterwarnings("ignore")
-SCATS_DATA = ScatsData()
 
 
-def train_model(model_to_use, x_train, y_train, save_location, filename, config):
+def train_model(model_to_use, x_train, y_train, save_location, filename, config, scaler=None, network_type=None,
+                lag=None, data_hash=None):
     """ Train a single model
 
     Parameters:
         model_to_use  (model.model): neural network model to train
-        x_train (array.py): input data for training
-        y_train (array.py): result data for training
+        x_train (array.py): input data for training, or a TrainingSequence that generates the batches
+        y_train (array.py): result data for training (None when x_train is a TrainingSequence)
         save_location (String): file directory to save model in
         filename (String): name of the file to save the model to
         config (dict): parameter values for training
+        scaler (Scaler): the scaler the training data was scaled with, saved next to the model
+        network_type (String): the kind of network being trained, saved next to the model
+        lag (int): the number of earlier volumes the model is given (None for the generalised models)
+        data_hash (String): identifies the data the model was trained on (the version of the site's or the whole
+            dataset), saved next to the model
     """
 
     metrics_to_use = ['mse', 'mae']
     model_to_use.compile(loss=[metrics_to_use[0]], optimizer="adam", metrics=metrics_to_use)
     # early = EarlyStopping(monitor='val_loss', patience=30, verbose=0, mode='auto')
 
-    train_size = int(len(x_train) * .9)
-    x_test = x_train[0:][train_size:]
-    y_test = y_train[0:][train_size:]
-    x_train = x_train[0:][:train_size]
-    y_train = y_train[0:][:train_size]
-
-    hist = model_to_use.fit(
-        x_train, y_train,
-        batch_size=config["batch"],
-        epochs=config["epochs"],
-        validation_split=0.1)
-    model_to_use.summary()
-    score = model_to_use.evaluate(
-        x_test,
-        y_test,
-        batch_size=config["batch"],
-        verbose=1)
+    if isinstance(x_train, TrainingSequence):
+        # Same 81/9/10 train/validation/test split as the in-memory data, without materialising it
+        x_train, x_test = x_train.split(.9)
+        x_train, x_validation = x_train.split(.9)
+
+        try:
+            hist = model_to_use.fit(
+                x_train,
+                epochs=config["epochs"],
+                validation_data=x_validation,
+                shuffle=False)
+            model_to_use.summary()
+            score = model_to_use.evaluate(
+                x_test,
+                verbose=1)
+        finally:
+            # Stop the threads preparing the batches
+            for sequence in x_train, x_validation, x_test:
+                sequence.close()
+    else:
+        train_size = int(len(x_train) * .9)
+        x_test = x_train[0:][train_size:]
+        y_test = y_train[0:][train_size:]
+        x_train = x_train[0:][:train_size]
+        y_train = y_train[0:][:train_size]
+
+        hist = model_to_use.fit(
+            x_train, y_train,
+            batch_size=config["batch"],
+            epochs=config["epochs"],
+            validation_split=0.1)
+        model_to_use.summary()
+        score = model_to_use.evaluate(
+            x_test,
+            y_test,
+            batch_size=config["batch"],
+            verbose=1)
 
     print('Scores:')
     for index, metric in enumerate(metrics_to_use):
@@ -61,6 +89,8 @@ def train_model(model_to_use, x_train, y_train, save_location, filename, config)
 
     print("Saving {0}{1}.h5".format(save_location, filename))
     model_to_use.save("{0}{1}.h5".format(save_location, filename))
+    manifest = ModelManifest.from_model(model_to_use, network_type, lag, scaler, data_hash)
+    manifest.save(get_manifest_file("{0}{1}.h5".format(save_location, filename)))
 
     df = pd.DataFrame.from_dict(hist.history)
     df.to_csv("{0}{1}_loss.csv".format(save_location, filename), encoding='utf-8', index=False)
@@ -68,7 +98,7 @@ def train_model(model_to_use, x_train, y_train, save_location, filename, config)
     print("Training complete")
 
 
-def train_seas(models, x_train, y_train, save_location, filename, config):
+def train_seas(models, x_train, y_train, save_location, filename, config, scaler=None, lag=None, data_hash=None):
     """ Train the SAEs model
 
     Parameters:
@@ -78,6 +108,9 @@ def train_seas(models, x_train, y_train, save_location, filename, config):
         save_location (String): file directory to save model in
         filename (String): name of the file to save the model to
         config (dict): parameter values for training
+        scaler (Scaler): the scaler the training data was scaled with, saved next to the model
+        lag (int): the number of earlier volumes the model is given (None for the generalised models)
+        data_hash (String): identifies the data the model was trained on, saved next to the model
     """
 
     train_size = int(len(x_train) * .9)
@@ -120,7 +153,7 @@ def train_seas(models, x_train, y_train, save_location, filename, config):
         weights = models[i].get_layer('hidden').get_weights()
         saes.get_layer('hidden%d' % (i + 1)).set_weights(weights)
 
-    train_model(saes, x_train, y_train, save_location, filename, config)
+    train_model(saes, x_train, y_train, save_location, filename, config, scaler, 'seas', lag, data_hash)
 
 
 def train_with_args(scats, junction, model_to_train):
@@ -136,7 +169,7 @@ def train_with_args(scats, junction, model_to_train):
     print(f"(train.py) CONFIG: {config}")
     file_directory = 'model/' + model_to_train
     if scats != "All":
-        junctions = SCATS_DATA.get_scats_approaches(scats)      # Get array of scats approaches, e.g: [1, 3, 5, 7]
+        junctions = get_scats_data().get_scats_approaches(scats)      # Get array of scats approaches, e.g: [1, 3, 5, 7]
         print(f"(train.py) SCATS SITES: {junctions}")
         file_directory = f"{file_directory}/{scats}/"
         filename = junction
@@ -146,17 +179,32 @@ def train_with_args(scats, junction, model_to_train):
                                                             # TODO: Determine if strings are an issue here
         for junction in junctions:
             print("Training {0}/{1} using a {2} model...".format(scats, junction, model_to_train))
-            x_train, y_train, _, _, _ = process_data(scats, junction, config["lag"])
+            x_train, y_train, _, _, scaler = process_data(scats, junction, config["lag"])
+            scaler = Scaler.from_sklearn(scaler)
+        lag = config["lag"]
+        # The windows are shuffled, so the data is identified by the version of the site's data rather than its hash
+        data_hash = get_scats_data().get_data_version(scats)
     else:
         file_directory = f"{file_directory}/Generalised/"
         filename = "Model"
         print("Training a generalised {0} model...".format(model_to_train))
-        x_train, y_train = SCATS_DATA.get_training_data()
+        if model_to_train == 'seas':
+            # The SAEs are trained layer by layer on the predictions of the previous layer, so need the full set
+            x_train, y_train = get_scats_data().get_training_data()
+        else:
+            # Generate the batches on the fly so the training set never has to fit in memory
+            x_train = TrainingSequence(get_scats_data(), config["batch"], expand_dims=True)
+            y_train = None
+        # The generalised models are trained on volumes divided by the maximum traffic
+        scaler = Scaler(0, get_scats_data().MAX_TRAFFIC)
+        lag = None
+        data_hash = get_scats_data().get_data_version()
         scats_site = "All"
         junction = "All"
 
-    print(f"(train.py) XTRAIN[0]: {x_train[0][:10]} \n XTRAIN[1]: {x_train[1][:10]} \n YTRAIN: {y_train[:10]}")
-    print(f"(traint.py) XTRAIN SHAPE: {x_train.shape} \n YTRAIN SHAPE: {y_train.shape}")
+    if y_train is not None:
+        print(f"(train.py) XTRAIN[0]: {x_train[0][:10]} \n XTRAIN[1]: {x_train[1][:10]} \n YTRAIN: {y_train[:10]}")
+        print(f"(traint.py) XTRAIN SHAPE: {x_train.shape} \n YTRAIN SHAPE: {y_train.shape}")
 
     if os.path.isfile(f"{file_directory}{filename}.h5"):
         m = load_model(f"{file_directory}{filename}.h5")
@@ -166,10 +214,11 @@ def train_with_args(scats, junction, model_to_train):
 
     if model_to_train == 'seas':
         x_train = np.reshape(x_train, (x_train.shape[0], x_train.shape[1]))
-        train_seas(m, x_train, y_train, file_directory, filename, config)
+        train_seas(m, x_train, y_train, file_directory, filename, config, scaler, lag, data_hash)
     else:
-        x_train = np.reshape(x_train, (x_train.shape[0], x_train.shape[1], 1))
-        train_model(m, x_train, y_train, file_directory, filename, config)
+        if y_train is not None:
+            x_train = np.reshape(x_train, (x_train.shape[0], x_train.shape[1], 1))
+        train_model(m, x_train, y_train, file_directory, filename, config, scaler, model_to_train, lag, data_hash)
 
 
 def generate_new_model(model_to_train, input_shape):
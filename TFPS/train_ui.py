@@ -2,13 +2,11 @@ import threading
 
 from PyQt5 import QtCore, QtGui, QtWidgets
 
-from data.scats import ScatsData
+from data.scats import get_scats_data
 from train import train_with_args
 from utility import ConsoleStream, get_setting
 
 
-SCATS_DATA = ScatsData()
-
 DEFAULT_FONT = QtGui.QFont()
 DEFAULT_FONT.setFamily("Arial")
 DEFAULT_FONT.setPointSize(10)
@@ -206,16 +204,17 @@ class UiTrain(object):
         for model in models:
             self.model_combo_box.addItem(model)
 
-        scats_numbers = SCATS_DATA.get_all_scats_numbers()
+        scats_data = get_scats_data()
+        scats_numbers = scats_data.get_all_scats_numbers()
 
         self.scats_number_combo_box.addItem("All")
         self.junction_combo_box.addItem("All")
         for scats in scats_numbers:
             self.scats_number_combo_box.addItem(str(scats))
-            self.scats_info[str(scats)] = SCATS_DATA.get_scats_approaches(scats)
+            self.scats_info[str(scats)] = scats_data.get_scats_approaches(scats)
             i = 0
             for location in self.scats_info[str(scats)]:
-                self.scats_info[str(scats)][i] = SCATS_DATA.get_location_name(scats, location)
+                self.scats_info[str(scats)][i] = scats_data.get_location_name(scats, location)
                 i += 1
         self.junction_combo_box.setEnabled(False)
 
@@ -250,7 +249,7 @@ class UiTrain(object):
             scats_number = int(scats_number)
         junction = self.junction_combo_box.itemText(self.junction_combo_box.currentIndex())
         if junction != "All":
-            junction = int(SCATS_DATA.get_location_id(junction))
+            junction = int(get_scats_data().get_location_id(junction))
         model = self.model_combo_box.itemText(self.model_combo_box.currentIndex()).lower()
 
         while True:
@@ -12,6 +12,8 @@ SIN_DAYS = {}
 COS_DAYS = {}
 DAYS_OF_WEEK = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
 TIME_INTERVALS = {}
+# The compass directions, numbered 1-8 clockwise from north the same as the locations
+DIRECTION_NUMBERS = {"N": 1, "NE": 2, "E": 3, "SE": 4, "S": 5, "SW": 6, "W": 7, "NW": 8}
 for i in range(8):
     DIRECTIONS_SINE[i] = 0.5 * np.sin(2 * np.pi * i / 8) + 0.5
     DIRECTIONS_COSINE[i] = 0.5 * np.cos(2 * np.pi * i / 8) + 0.5
@@ -22,6 +24,8 @@ for i in range(96):
 for i, day in enumerate(DAYS_OF_WEEK):
     SIN_DAYS[day] = 0.5 * np.sin(2 * np.pi * i / 7) + 0.5
     COS_DAYS[day] = 0.5 * np.cos(2 * np.pi * i / 7) + 0.5
+SIN_DAYS_OF_WEEK = np.array([SIN_DAYS[day] for day in DAYS_OF_WEEK])
+COS_DAYS_OF_WEEK = np.array([COS_DAYS[day] for day in DAYS_OF_WEEK])
 settings: {}
 # Loads the settings into a dictionary
 with open('config.json', 'r') as f:
@@ -81,6 +85,51 @@ def convert_date_to_cyclic_day(date):
     return SIN_DAYS[day_of_week], COS_DAYS[day_of_week]
 
 
+def convert_direction_to_number(direction):
+    """ Converts a direction (1-8, or a compass direction such as "NE") into its number (1-8) """
+    return DIRECTION_NUMBERS[direction] if isinstance(direction, str) else int(direction)
+
+
+def convert_time_to_interval(time):
+    """ Converts a time of day in the format ##:## into its 15 minute interval of the day (0-95) """
+    if time in TIME_INTERVALS:
+        return TIME_INTERVALS[time]
+    hours, minutes = (int(x) for x in time.split(':'))
+    return (hours * 60 + minutes) // 15
+
+
+def convert_date_string_to_day(date):
+    """ Converts a date in the format of 01/01/2019 into a datetime64 day """
+    day, month, year = (int(x) for x in date.split('/'))
+    return np.datetime64(datetime.date(year, month, day), "D")
+
+
+def convert_directions_to_cyclic(directions):
+    """ Encodes an array of directions (1-8, clockwise from north), anything else is encoded as zero """
+    directions = np.asarray(directions, dtype=np.int64)
+    valid = (directions > 0) & (directions < 9)
+    indices = np.clip(directions - 1, 0, 7)
+    return np.where(valid, DIRECTIONS_SINE[indices], 0), np.where(valid, DIRECTIONS_COSINE[indices], 0)
+
+
+def convert_time_intervals_to_cyclic(intervals):
+    """ Encodes an array of 15 minute intervals of the day (0-95) """
+    intervals = np.asarray(intervals, dtype=np.int64)
+    return SIN_TIMES[intervals], COS_TIMES[intervals]
+
+
+def convert_dates_to_days_of_week(dates):
+    """ Gets the day of the week of an array of dates, with Monday as 0 """
+    # 1970-01-01 was a Thursday
+    return (np.asarray(dates, dtype="datetime64[D]").astype(np.int64) + 3) % 7
+
+
+def convert_dates_to_cyclic_days(dates):
+    """ Encodes the day of the week of an array of dates """
+    days_of_week = convert_dates_to_days_of_week(dates)
+    return SIN_DAYS_OF_WEEK[days_of_week], COS_DAYS_OF_WEEK[days_of_week]
+
+
 class ConsoleStream(QtCore.QObject):
     """ Handles the system-specific functions for stdout """
     text_output = QtCore.pyqtSignal(str)